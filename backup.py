@@ -9,6 +9,7 @@
 #     "requests",
 #     "helium",
 #     "python-dotenv",
+#     "httpx",
 # ]
 # ///
 
@@ -28,12 +29,89 @@ from rich.console import Console
 from rich.table import Table
 from download_cover_arts_of_playlist import download_artworks
 from update_artist_counts import update_artist_counts
+from spotify_async import (
+    AsyncSpotify,
+    fetch_liked_tracks_since,
+    fetch_playlists_items,
+    fetch_snapshot_ids,
+    playlist_id,
+)
 
 
 def git_add(path: Path | str):
     run(["git", "add", str(path)], capture_output=True)
 
 
+class CountingSpotify:
+    """
+    Wraps a Spotify client to count the calls made through it.
+    Calls whose result doesn't change during a run are only made once.
+    """
+
+    client: Spotify
+    calls: int
+
+    def __init__(self, client: Spotify) -> None:
+        self.client = client
+        self.calls = 0
+        self._current_user = None
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self.client, name)
+        if not callable(attribute):
+            return attribute
+
+        def counted(*args, **kwargs):
+            self.calls += 1
+            return attribute(*args, **kwargs)
+
+        return counted
+
+    def current_user(self) -> dict:
+        if self._current_user is None:
+            self._current_user = self.__getattr__("current_user")()
+        return self._current_user
+
+
+class ApiCalls:
+    """
+    Number of Spotify API calls made by each phase of the backup, to notice when one starts making way more than it should
+    """
+
+    per_phase: dict[str, int]
+
+    def __init__(self) -> None:
+        self.per_phase = {}
+        self._current = None
+        self._start = 0
+
+    @staticmethod
+    def total() -> int:
+        return spotify.calls + AsyncSpotify.requests_made
+
+    def phase(self, name: str):
+        self.end()
+        print(name)
+        self._current = name
+        self._start = self.total()
+
+    def end(self):
+        if self._current:
+            self.per_phase[self._current] = self.total() - self._start
+            self._current = None
+
+    def report(self):
+        self.end()
+        table = Table.grid(padding=(0, 2))
+        table.add_column(style="dim")
+        table.add_column(justify="right", style="bold")
+        for name, calls in self.per_phase.items():
+            table.add_row(name, str(calls))
+        table.add_row("Total", str(sum(self.per_phase.values())))
+        print("API calls made:")
+        Console().print(table)
+
+
 MAX_UPDATE_AGE = timedelta(hours=4)
 
 here = Path(__file__).parent
@@ -62,7 +140,7 @@ if not gitignore.exists() or "\nsecrets.json\n" not in gitignore.read_text():
 
 # Initial setup
 print("Initializing spotify client")
-spotify = Spotify(
+spotify = CountingSpotify(Spotify(
     auth_manager=SpotifyOAuth(
         scope=[
             "user-follow-modify",
@@ -78,7 +156,8 @@ spotify = Spotify(
         redirect_uri="http://127.0.0.1:8080",
         cache_handler=MemoryCacheHandler(),
     )
-)
+))
+api_calls = ApiCalls()
 
 print("Getting access token")
 tokens["access_token"] = spotify.auth_manager.get_access_token(as_dict=False)
@@ -86,37 +165,92 @@ tokens["scopes"] = spotify.auth_manager.scope
 (here / "secrets.json").write_text(json.dumps(tokens), encoding="utf8")
 
 
-def sync_tsv_file(results: dict[Literal["items"], list], target: Path):
+def fix_quoting(tracks):
+    return {re.sub(r'"([^"]+)"', r"“\1”", track).replace('" ', "” ").replace(' "', " “").replace('"', "“") for track in tracks}
+
+
+def merge_into_sorted_file(target: Path, rows: list[str]) -> list[str]:
+    """
+    Inserts the sorted rows into target, whose lines (after the header) are sorted, skipping those already there.
+    Streams target into a temporary file that then replaces it, so only rows are held in memory.
+    Returns the rows that were added. target is left untouched if there are none.
+    Falls back to rewrite_sorted_file when a line is out of order or has straight quotes, i.e. when the file was edited by hand.
+    """
+    added = []
+    temporary = target.with_name(f".{target.name}.tmp")
+    with target.open(encoding="utf8") as existing, temporary.open("w", encoding="utf8") as merged:
+        merged.write(existing.readline().rstrip("\n"))
+        i = 0
+        previous = ""
+        for line in existing:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            if line < previous or '"' in line:
+                # Not sorted or not quoted like rows are, merging would miss duplicates
+                merged.close()
+                temporary.unlink()
+                return rewrite_sorted_file(target, rows)
+            previous = line
+            while i < len(rows) and rows[i] <= line:
+                if rows[i] != line:
+                    merged.write("\n" + rows[i])
+                    added.append(rows[i])
+                i += 1
+            merged.write("\n" + line)
+        for row in rows[i:]:
+            merged.write("\n" + row)
+            added.append(row)
+
+    if added:
+        temporary.replace(target)
+    else:
+        temporary.unlink()
+    return added
+
+
+def rewrite_sorted_file(target: Path, rows: list[str]) -> list[str]:
+    """
+    For files that were edited by hand: fixes quoting of every line and sorts the whole file
+    """
+    lines = target.read_text("utf8").splitlines()
+    header, tracks = lines[0], fix_quoting(lines[1:])
+    added = sorted(set(rows) - tracks)
+    if not added:
+        return []
+    temporary = target.with_name(f".{target.name}.tmp")
+    temporary.write_text("\n".join([header] + sorted(tracks | set(added))), encoding="utf8")
+    temporary.replace(target)
+    return added
+
+
+def sync_tsv_file(results: dict[Literal["items"], list], target: Path) -> list[str]:
+    """
+    Returns the rows that were added to target
+    """
     print(f"Syncing {target}")
 
-    # Fix quoting
-    def fix_quoting(tracks):
-        return {re.sub(r'"([^"]+)"', r"“\1”", track).replace('" ', "” ").replace(' "', " “").replace('"', "“") for track in tracks}
-
     if not target.exists():
         print(f"⋆𐙚₊˚⊹♡ Creating [bold][magenta]{target}[reset] ⋆౨ৎ˚⟡˖ ࣪")
         target.write_text("Artist\tTitle\tMore info\n", encoding="utf8")
 
-    # Get whole library
-    lib = list(target.read_text("utf8").splitlines())
-    tracks, header = set(lib[1:]), lib[0]
-    tracks = fix_quoting(tracks)
-
     # Boil them down to (artists, title, album)
-    new_tracks = (
-        fix_quoting(
-            {
-                "\t".join(
-                    [
-                        ", ".join(a["name"] for a in t["track"].get("artists", [])),
-                        t["track"].get("name", None),
-                        # t["track"]["album"]["name"],
-                    ]
-                )
-                for t in results["items"]
-            }
-        )
-        - tracks
+    new_tracks = merge_into_sorted_file(
+        target,
+        sorted(
+            fix_quoting(
+                {
+                    "\t".join(
+                        [
+                            ", ".join(a["name"] for a in t["track"].get("artists", [])),
+                            t["track"].get("name", None),
+                            # t["track"]["album"]["name"],
+                        ]
+                    )
+                    for t in results["items"]
+                }
+            )
+        ),
     )
 
     if new_tracks:
@@ -135,23 +269,16 @@ def sync_tsv_file(results: dict[Literal["items"], list], target: Path):
         print(
             f"⋆𐙚₊˚⊹♡ Nyathing new to add to [magenta][bold]{target}[reset]. Go listen to sum new music :3 ⋆౨ৎ˚⟡˖ ࣪"
         )
-        return
+        return []
 
     print("")
 
-    # Add our tracks
-    tracks |= new_tracks
-    # Sort
-    tracks = list(tracks)
-    tracks.sort()
-    # Write back library
-    target.write_text("\n".join([header] + tracks), encoding="utf8")
-
     git_add(target)
+    return new_tracks
 
 
 # Get playlists defined on Spotify by user
-print("Syncing playlists")
+api_calls.phase("Listing playlists")
 playlists_resp = spotify.current_user_playlists()
 playlists = playlists_resp["items"]
 while playlists_resp["next"]:
@@ -159,44 +286,77 @@ while playlists_resp["next"]:
     playlists.extend(playlists_resp["items"])
 
 # Store IDs of playlists we have to autocreate
+user_id = spotify.current_user()["id"]
 autocreate_playlists = set(
     [
         playlist["external_urls"]["spotify"]
         for playlist in playlists
-        if playlist["owner"]["id"] == spotify.current_user()["id"]
+        if playlist["owner"]["id"] == user_id
     ]
 )
 
 
 # Get tracks from API
-print("Syncing liked tracks")
-results = spotify.current_user_saved_tracks()
+api_calls.phase("Syncing liked tracks")
+# Only the tracks liked since the newest one of the last run, all of them on the first run
+liked = fetch_liked_tracks_since(tokens["access_token"], tokens.get("liked_until"))
 
-sync_tsv_file(results, here / "library.tsv")
+liked_rows = sync_tsv_file({"items": liked}, here / "library.tsv")
 
-print("Syncing playlists")
+if liked:
+    tokens["liked_until"] = max(item["added_at"] for item in liked)
+    (here / "secrets.json").write_text(json.dumps(tokens), encoding="utf8")
+
+api_calls.phase("Syncing playlists")
+definitions = {}
 for playlist_definition_file in here.glob("**/autofill.yaml"):
     definition = yaml.safe_load(playlist_definition_file.read_text())
     if not definition.get("from", "").startswith("https://open.spotify.com/playlist/"):
         continue
 
     autocreate_playlists.discard(definition["from"])
+    definitions[playlist_definition_file] = definition
+
+# Playlists listed above come with their snapshot_id, only ask for the others
+snapshot_ids = {playlist["id"]: playlist["snapshot_id"] for playlist in playlists}
+unlisted = [
+    d["from"] for d in definitions.values() if playlist_id(d["from"]) not in snapshot_ids
+]
+for url, snapshot_id in fetch_snapshot_ids(tokens["access_token"], unlisted).items():
+    snapshot_ids[playlist_id(url)] = snapshot_id
+
+
+def snapshot_file(playlist_definition_file: Path) -> Path:
+    """
+    Also read by fill_playlists.py, to know whether tracklist.tsv is up to date
+    """
+    return playlist_definition_file.parent / "tracklist.snapshot_id"
+
+
+changed = {
+    playlist_definition_file: definition
+    for playlist_definition_file, definition in definitions.items()
+    if not (playlist_definition_file.parent / "tracklist.tsv").exists()
+    or not snapshot_file(playlist_definition_file).exists()
+    or snapshot_file(playlist_definition_file).read_text("utf8").strip()
+    != snapshot_ids[playlist_id(definition["from"])]
+}
+print(f"{len(definitions) - len(changed)} playlists unchanged since last backup")
+
+# Fetch every playlist's pages at once instead of one after the other
+playlists_items = fetch_playlists_items(
+    tokens["access_token"], list({d["from"] for d in changed.values()})
+)
 
-    results = spotify.playlist_tracks(
-        definition["from"],
-        limit=100,
-    )
-    tracks = results["items"]
-    get_all = not Path("tracklist.tsv").exists()
-    get_all = True
-    while get_all and results["next"]:
-        results = spotify.next(results)
-        tracks.extend(results["items"])
-
+for playlist_definition_file, definition in changed.items():
     sync_tsv_file(
-        {"items": tracks},
+        {"items": playlists_items[definition["from"]]},
         playlist_definition_file.parent / "tracklist.tsv",
     )
+    snapshot_file(playlist_definition_file).write_text(
+        snapshot_ids[playlist_id(definition["from"])], encoding="utf8"
+    )
+    git_add(snapshot_file(playlist_definition_file))
 
     if playlist_definition_file.parent.stem == "niceartworks":
         download_artworks(definition["from"], here / "niceartworks")
@@ -204,12 +364,9 @@ for playlist_definition_file in here.glob("**/autofill.yaml"):
 
 
 # Create playlists we have to create
+names = {playlist["external_urls"]["spotify"]: playlist["name"] for playlist in playlists}
 for spotifyurl in autocreate_playlists:
-    name = next(
-        playlist["name"]
-        for playlist in playlists
-        if playlist["external_urls"]["spotify"] == spotifyurl
-    )
+    name = names[spotifyurl]
     print(f"⋆𐙚₊˚⊹♡ Creating playlist [bold][magenta]{name}[reset] ⋆౨ৎ˚⟡˖ ࣪")
     try:
         Path(here, name).mkdir(exist_ok=True, parents=True)
@@ -221,7 +378,7 @@ for spotifyurl in autocreate_playlists:
         print(f"\tCouldn't create playlist: {e}")
 
 # Get all followed artists
-print("Syncing followed artists")
+api_calls.phase("Syncing followed artists")
 get_all = False
 results = spotify.current_user_followed_artists(limit=50)
 artists = set(
@@ -241,8 +398,11 @@ Path("followed_artists.txt").write_text(
 )
 git_add("followed_artists.txt")
 
+api_calls.report()
+
 print("Syncing liked counts")
-update_artist_counts()
+# Only count the artists of tracks that were just added to library.tsv
+update_artist_counts(added_rows=liked_rows)
 git_add("counts.tsv")
 
 git_add(__file__)
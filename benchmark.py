@@ -0,0 +1,166 @@
+# /// script
+# requires-python = ">=3.12"
+# dependencies = [
+#     "rich",
+#     "docopt",
+# ]
+# ///
+
+"""
+Usage:
+    benchmark.py lookup [--tracks=<n>]
+    benchmark.py yt-dlp [--tracks=<n>] [--startup=<seconds>]
+    benchmark.py matching [--tracks=<n>]
+
+lookup runs against a fake library of empty mp3 files named after the rows of library.tsv, so no music needs to be downloaded.
+yt-dlp compares one yt-dlp process per track with download.py --in-process, using fake_yt_dlp.py in place of yt-dlp.
+matching evaluates every */autofill.yaml against that fake library, with from: playlists resolved from their tracklist.tsv.
+
+Options:
+    --tracks=<n>           Number of tracks to resolve or download [default: 300]
+    --startup=<seconds>    Time fake_yt_dlp.py takes to start up, on top of the Python interpreter's [default: 0.3]
+"""
+
+#!/usr/bin/env python
+from contextlib import contextmanager, redirect_stdout
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import random
+import sys
+from docopt import docopt
+from rich import print
+from library import LibraryIndex, scan, find_file_of_track
+
+here = Path(__file__).parent
+
+
+@contextmanager
+def fake_library():
+    """
+    Yields (directory, rows) where directory contains one empty mp3 per (artist, title) row of library.tsv
+    """
+    rows = [
+        line.replace("/", "⁄").split("\t")[:2]
+        for line in (here / "library.tsv").read_text("utf8").splitlines()[1:]
+        if line.count("\t") >= 1 and not line.startswith("# vim")
+    ]
+    with TemporaryDirectory() as directory:
+        directory = Path(directory)
+        created = []
+        for i, (artist, title) in enumerate(rows):
+            try:
+                (directory / f"{artist}  {title}  {i:011d}.mp3").touch()
+                created.append((artist, title))
+            except OSError:
+                # File name too long, yt-dlp wouldn't be able to download it either
+                pass
+        yield directory, created
+
+
+@contextmanager
+def timed(label: str):
+    start = perf_counter()
+    yield
+    print(f"{label}: [bold]{perf_counter() - start:.3f}s")
+
+
+def lookup(tracks: int):
+    with fake_library() as (directory, rows):
+        queries = random.Random(0).sample(rows, min(tracks, len(rows)))
+        print(f"Resolving {len(queries)} tracks in a library of {len(rows)} files")
+
+        with timed("find_file_of_track (one directory scan per track)"):
+            for artist, title in queries:
+                find_file_of_track(
+                    [t.filepath for t in scan(directory)],
+                    artists=set(artist.split(", ")),
+                    title=title,
+                )
+
+        with timed("LibraryIndex (one directory scan)"):
+            index = LibraryIndex.of_directory(directory)
+            for artist, title in queries:
+                index.find(set(artist.split(", ")), title)
+
+
+def yt_dlp(tracks: int, startup: float):
+    import download
+    import fake_yt_dlp
+
+    rows = [
+        line.replace("/", "⁄").split("\t")[:2]
+        for line in (here / "library.tsv").read_text("utf8").splitlines()[1:]
+        if line.count("\t") >= 1 and not line.startswith("# vim")
+    ]
+    queries = random.Random(0).sample(rows, min(tracks, len(rows)))
+    print(f"Downloading {len(queries)} tracks with a fake yt-dlp that takes {startup}s to start up")
+
+    with TemporaryDirectory() as directory:
+        download.library_file = Path(directory) / "library.tsv"
+        with timed("One yt-dlp process per track"):
+            for track in queries:
+                download.fetch(
+                    track,
+                    yt_dlp=f"{sys.executable} {here / 'fake_yt_dlp.py'} --fake-startup {startup}",
+                    quiet=True,
+                )
+
+    with TemporaryDirectory() as directory:
+        download.library_file = Path(directory) / "library.tsv"
+        with timed("One YoutubeDL instance for all tracks"):
+            for track in queries:
+                download.fetch_in_process(
+                    track, fake_yt_dlp, options=["--fake-startup", str(startup)]
+                )
+
+
+def matching(tracks: int):
+    from fill_playlists import PlaylistSpec, pick_all, read_tracklist
+
+    with fake_library() as (directory, rows):
+        index = LibraryIndex.of_directory(directory)
+        specs = []
+        with redirect_stdout(StringIO()):
+            for file in sorted(here.glob("**/autofill.yaml")):
+                try:
+                    spec = PlaylistSpec.from_yaml(file, index, fetch_from=False)
+                except KeyError:
+                    # tracks: lists a track that isn't in library.tsv
+                    continue
+                if (file.parent / "tracklist.tsv").exists():
+                    for artists, title in read_tracklist(file.parent / "tracklist.tsv"):
+                        try:
+                            spec.tracks.add(index.find(artists, title))
+                        except KeyError:
+                            pass
+                specs.append(spec.compile())
+
+        sample = random.Random(0).sample(index.tracks, min(tracks, len(index)))
+        print(f"Matching {len(index)} tracks against {len(specs)} playlists")
+
+        with timed(f"Compiled specs, all {len(index)} tracks"):
+            picked = sum(spec.matches(track) for spec in specs for track in index)
+
+        with timed(f"Specs compiled on every evaluation, {len(sample)} tracks"):
+            for spec in specs:
+                uncompiled = spec._replace(compiled=None)
+                for track in sample:
+                    uncompiled.matches(track)
+
+        with timed(f"pick_all, single pass over all {len(index)} tracks"):
+            picked_all, _ = pick_all(specs, index)
+
+        assert sum(map(len, picked_all)) == picked
+        print(f"{picked} (playlist, track) pairs matched")
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    if args["lookup"]:
+        lookup(int(args["--tracks"]))
+    if args["yt-dlp"]:
+        yt_dlp(int(args["--tracks"]), float(args["--startup"]))
+    if args["matching"]:
+        matching(int(args["--tracks"]))
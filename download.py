@@ -8,143 +8,407 @@
 #     "docopt",
 #     "python-dotenv",
 #     "tqdm",
+#     "yt-dlp",
 # ]
 # ///
 
 """
-Usage: download.py [<library-file>]
+Usage: download.py [options] [<library-file>]
 
 Where library-file is a TSV file with the following format:
 Artist    Title
+
+Options:
+    -j --jobs=<n>         Number of downloads to run at once [default: 4]
+    --timeout=<seconds>   Give up on a download attempt after that long [default: 600]
+    --retries=<n>         Retry downloads that failed or timed out that many times [default: 2]
+    --yt-dlp=<command>    Command used to run yt-dlp, e.g. "python fake_yt_dlp.py" to try things out offline [default: yt-dlp]
+    --in-process          Use yt-dlp's Python API from this process instead of starting a yt-dlp process per track. Ignores --timeout and --yt-dlp.
 """
 
 #!/usr/bin/env python
 from sys import argv, exit
 from tqdm import tqdm
 from pathlib import Path
-from subprocess import run
+from subprocess import run, TimeoutExpired
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import shlex
+from threading import Lock, local
+from types import ModuleType
 import requests
 import json
 from bs4 import BeautifulSoup
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
-from mutagen.easyid3 import EasyID3
 from rich import print
 from dotenv import load_dotenv
 from hashlib import md5
+from time import perf_counter, sleep
+from typing import Optional
 from docopt import docopt
-
-args = docopt(__doc__)
+from library import Catalog, cache_directory, normalize_title, tag_track
 
 here = Path(__file__).parent
 load_dotenv(here / ".env")
 spotify = spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials())
 
-library_file = Path(args["<library-file>"] or here / "library.tsv")
-print(f"Using library file: {library_file}")
-library = [
-    t.replace("/", "⁄").split("\t", 2)
-    for t in library_file.read_text("UTF-8").splitlines()
+library_file = here / "library.tsv"
+
+# Seconds to wait before the first retry, doubled on each subsequent one
+RETRY_BACKOFF = 5
+
+YT_DLP_OPTIONS = [
+    "--remote-components", "ejs:github",
+    "-x",
+    "--audio-format",
+    "mp3",
+    "--max-downloads=1",
+    "--ignore-errors",
+    "--age-limit=20",  # to prevent download errors due to agewall
 ]
 
 
-def tag_track(title: str, artists: set[str], file: Path) -> bool:
+def read_library(library_file: Path) -> list[list[str]]:
+    return [
+        t.replace("/", "⁄").split("\t", 2)
+        for t in library_file.read_text("UTF-8").splitlines()
+    ]
+
+
+class DownloadJournal:
     """
-    Returns True if the tag was applied, False if it was already applied
+    Append-only log of the state each track reached, one JSON object per line, so that an interrupted run can be resumed.
+    A track goes through queued → fetching → fetched → tagged → renamed, or ends up missing when yt-dlp found nothing,
+    or failed when the downloaded file couldn't be tagged or renamed.
     """
-    track = EasyID3(str(file))
-    if set(track.get("artist", [])) == artists and track.get("title", [])[0] == title:
-        # print(f"Checked {track.get('artist', [])!r} against {artists!r}")
-        # print(f"Checked {track.get('title', [''])[0]!r} against {title!r}")
-        # print("⤷  Skipped")
-        return False
-    track["title"] = title
-    track["artist"] = "\0".join(artists)
-    track.save()
-    print(f"Tagged {file.name!r} as {', '.join(artists)} — {title}")
-    return True
 
+    STATES = ("queued", "fetching", "fetched", "tagged", "renamed", "missing", "failed")
+    DONE = ("renamed", "missing", "failed")
 
-def download(track: tuple[str, str] | tuple[str, str, str]) -> bool:
+    path: Path
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._lock = Lock()
+
+    def record(self, track: tuple[str, ...], state: str, file: Optional[Path] = None):
+        assert state in self.STATES
+        line = json.dumps(
+            {"track": list(track), "state": state, "file": file.name if file else None},
+            ensure_ascii=False,
+        )
+        with self._lock, self.path.open("a", encoding="utf-8") as journal:
+            journal.write(line + "\n")
+            journal.flush()
+
+    def replay(self) -> dict[tuple[str, ...], tuple[str, Optional[str]]]:
+        """
+        Returns the last (state, file name) recorded for each track, in the order tracks were first queued
+        """
+        if not self.path.exists():
+            return {}
+        states = {}
+        for line in self.path.read_text("utf-8").splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Last line got cut off by a crash
+                continue
+            states[tuple(entry["track"])] = (entry["state"], entry["file"])
+        return states
+
+    def unfinished(self) -> dict[tuple[str, ...], tuple[str, Optional[str]]]:
+        return {
+            track: (state, file)
+            for track, (state, file) in self.replay().items()
+            if state not in self.DONE
+        }
+
+    def clear(self):
+        self.path.unlink(missing_ok=True)
+
+
+def split_track(track: tuple[str, str] | tuple[str, str, str]) -> tuple[str, str, str]:
     """
-    Returns True if the download succeeded False otherwise
+    Returns (artist, title, youtube link), the link being empty if the row doesn't have one
     """
     if len(track) == 3:
-        artist, title, yt_link = track
-    else:
-        yt_link = ""
-        artist, title = track
+        return tuple(track)
+    artist, title = track
+    return artist, title, ""
+
+
+def temporary_file_prefix(artist: str, title: str) -> str:
     # Use a MD5 hash to prevent youtube-dl from choking on weird file names.
-    hash = md5(bytes(artist + title, "utf-8")).hexdigest()
+    return md5(bytes(artist + title, "utf-8")).hexdigest()
+
+
+def remove_leftovers(track: tuple[str, str] | tuple[str, str, str]):
+    """
+    Removes what a yt-dlp run that got killed left behind for that track: partial downloads, unconverted or half-converted files.
+    """
+    artist, title, _ = split_track(track)
+    for leftover in library_file.parent.glob(f"{temporary_file_prefix(artist, title)}*"):
+        leftover.unlink(missing_ok=True)
+
+
+def fetch(
+    track: tuple[str, str] | tuple[str, str, str],
+    timeout: Optional[float] = None,
+    yt_dlp: str = "yt-dlp",
+    quiet: bool = False,
+) -> tuple[Optional[Path], int]:
+    """
+    Runs yt-dlp, unless a temporary file for that track is already there.
+    Returns (the downloaded temporary file or None, yt-dlp's return code).
+    Raises TimeoutExpired if yt-dlp took longer than timeout seconds.
+    """
+    artist, title, yt_link = split_track(track)
+    hash = temporary_file_prefix(artist, title)
+
+    if candidates := list(library_file.parent.glob(f"{hash}*.mp3")):
+        return candidates[0], 0
+
+    process = run(
+        [
+            *shlex.split(yt_dlp),
+            *YT_DLP_OPTIONS,
+            "--output",
+            str(library_file.parent / f"{hash}%(id)s.mp3"),
+            yt_link or f"ytsearch15:{artist} {title}",
+        ],
+        timeout=timeout,
+        capture_output=quiet,
+    )
 
     candidates = list(library_file.parent.glob(f"{hash}*.mp3"))
-    if not len(candidates):
-        try:
-            run(
-                [
-                    "yt-dlp",
-                    "--remote-components", "ejs:github",
-                    "-x",
-                    "--audio-format",
-                    "mp3",
-                    "--output",
-                    str(library_file.parent / f"{hash}%(id)s.mp3"),
-                    yt_link or f"ytsearch15:{artist} {title}",
-                    "--max-downloads=1",
-                    "--ignore-errors",
-                    "--age-limit=20",  # to prevent download errors due to agewall
-                ]
-            )
-        except KeyboardInterrupt:
-            print("Download skipped by user, continuing…")
-            return
+    return (candidates[0] if candidates else None), process.returncode
+
+
+_in_process = local()
+
+
+def fetch_in_process(
+    track: tuple[str, str] | tuple[str, str, str],
+    yt_dlp_module: Optional[ModuleType] = None,
+    options: list[str] = [],
+) -> tuple[Optional[Path], int]:
+    """
+    Like fetch, but through yt-dlp's Python API: each thread keeps one YoutubeDL instance around,
+    so yt-dlp's startup and extractor loading is paid once per thread instead of once per track.
+    yt_dlp_module defaults to yt_dlp, fake_yt_dlp can be passed instead.
+    options are added to the command-line options the YoutubeDL instance is created with.
+    """
+    artist, title, yt_link = split_track(track)
+    hash = temporary_file_prefix(artist, title)
+
+    if candidates := list(library_file.parent.glob(f"{hash}*.mp3")):
+        return candidates[0], 0
+
+    if getattr(_in_process, "ydl", None) is None:
+        if yt_dlp_module is None:
+            import yt_dlp as yt_dlp_module
+        # --break-per-input resets the --max-downloads count for every download() call
+        options = yt_dlp_module.parse_options([*YT_DLP_OPTIONS, "--break-per-input", "--quiet", *options])
+        _in_process.ydl = yt_dlp_module.YoutubeDL(options.ydl_opts)
+
+    ydl = _in_process.ydl
+    ydl.params["outtmpl"]["default"] = str(library_file.parent / f"{hash}%(id)s.mp3")
+    try:
+        ydl.download([yt_link or f"ytsearch15:{artist} {title}"])
+        returncode = 0
+    except Exception as e:
+        tqdm.write(f"yt-dlp errored out on {artist} — {title}: {e}")
+        returncode = 1
 
     candidates = list(library_file.parent.glob(f"{hash}*.mp3"))
-    if not candidates:
-        print("\tNot found on YouTube.")
-        return
+    return (candidates[0] if candidates else None), returncode
+
+
+def finish(
+    track: tuple[str, str] | tuple[str, str, str],
+    file: Path,
+    journal: Optional[DownloadJournal] = None,
+) -> Optional[Path]:
+    """
+    Tags the temporary file downloaded by fetch and renames it to its final name.
+    Returns the final path, or None if the file couldn't be renamed.
+    """
+    artist, title, _ = split_track(track)
+    hash = temporary_file_prefix(artist, title)
+    youtube_id = file.name.split(".")[0].replace(hash, "")
+    destination = library_file.parent / f"{artist}  {title.replace('/', '∕')}  {youtube_id}.mp3"
+    try:
+        # read_library replaced slashes, tags get the row as written in library.tsv, like tag.py writes them
+        tag_track(
+            artists=set(artist.replace("⁄", "/").split(", ")),
+            title=title.replace("⁄", "/"),
+            file=file,
+        )
+        if journal:
+            journal.record(track, "tagged", file)
+        file.rename(destination)
+    except OSError as e:
+        print(f"Couldn't rename file: {e}")
+        if journal:
+            journal.record(track, "failed", file)
+        return None
+    if journal:
+        journal.record(track, "renamed", destination)
+    return destination
 
-    file = candidates[0]
+
+def download(track: tuple[str, str] | tuple[str, str, str]) -> bool:
+    """
+    Returns True if the download succeeded False otherwise
+    """
     try:
-        youtube_id = file.name.split(".")[0].replace(hash, "")
+        file, _ = fetch(track)
+    except KeyboardInterrupt:
+        print("Download skipped by user, continuing…")
+        return False
+
+    if not file:
+        print("\tNot found on YouTube.")
+        return False
+
+    return finish(track, file) is not None
+
+
+def fetch_with_retries(
+    track: tuple[str, str] | tuple[str, str, str],
+    timeout: Optional[float],
+    retries: int,
+    yt_dlp: str,
+    journal: Optional[DownloadJournal] = None,
+    in_process: bool = False,
+) -> Optional[Path]:
+    """
+    Retries, with exponential backoff, attempts that timed out or where yt-dlp errored out without downloading anything.
+    yt-dlp exits with 0, or 101 when it stopped because of --max-downloads, when the search simply found nothing.
+    """
+    if journal:
+        journal.record(track, "fetching")
+    for attempt in range(retries + 1):
+        if attempt:
+            sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
         try:
-            tag_track(artists=artist.split(", "), title=title, file=file)
-            file.rename(library_file.parent / f"{artist}  {title.replace('/', '∕')}  {youtube_id}.mp3")
-        except OSError as e:
-            print(f"Couldn't rename file: {e}")
-    except IndexError as e:
-        print(f"[{hash}]")
-        print(f"\tTried using file {file} and youtube ID {youtube_id}")
-        print(e)
-        exit(1)
-        pass
-
-
-def main():
+            if in_process:
+                file, returncode = fetch_in_process(track)
+            else:
+                file, returncode = fetch(track, timeout=timeout, yt_dlp=yt_dlp, quiet=True)
+        except TimeoutExpired:
+            tqdm.write(f"Timed out downloading {' — '.join(track[:2])} (attempt {attempt + 1}/{retries + 1})")
+            # Otherwise the next attempt would take the partial file for a finished download
+            remove_leftovers(track)
+            continue
+        if file or returncode in (0, 101):
+            return file
+        tqdm.write(f"yt-dlp failed for {' — '.join(track[:2])} (attempt {attempt + 1}/{retries + 1})")
+    return None
+
+
+def download_all(
+    tracks: list[tuple],
+    jobs: int = 4,
+    timeout: Optional[float] = 600,
+    retries: int = 2,
+    yt_dlp: str = "yt-dlp",
+    journal: Optional[DownloadJournal] = None,
+    in_process: bool = False,
+) -> int:
+    """
+    Runs up to jobs yt-dlp processes at once. Tagging and renaming happens here as each download completes.
+    With in_process, runs yt-dlp through its Python API in jobs threads instead (timeout is not enforced then).
+    Returns the number of tracks that were downloaded.
+    """
+    downloaded = 0
+    if journal:
+        for track in tracks:
+            journal.record(track, "queued")
+    pool = ThreadPoolExecutor(max_workers=jobs)
+    try:
+        with tqdm(total=len(tracks), unit="track") as progress:
+            jobs_of = {
+                pool.submit(fetch_with_retries, track, timeout, retries, yt_dlp, journal, in_process): track
+                for track in tracks
+            }
+            for job in as_completed(jobs_of):
+                track = jobs_of[job]
+                progress.update()
+                if not (file := job.result()):
+                    tqdm.write(f"Not found on YouTube: {' — '.join(track[:2])}")
+                    if journal:
+                        journal.record(track, "missing")
+                    continue
+                if journal:
+                    journal.record(track, "fetched", file)
+                if finish(track, file, journal):
+                    downloaded += 1
+                progress.set_postfix(downloaded=downloaded)
+    except KeyboardInterrupt:
+        print("Downloads interrupted by user, cancelling remaining ones…")
+    finally:
+        pool.shutdown(cancel_futures=True)
+    return downloaded
+
+
+def resume(journal: DownloadJournal) -> list[tuple]:
+    """
+    Finishes tagging and renaming tracks that were already downloaded when the previous run got interrupted.
+    Returns the tracks that still need to be downloaded.
+    """
+    to_download = []
+    for track, (state, file) in journal.unfinished().items():
+        if state in ("queued", "fetching"):
+            # Only files recorded as fetched are complete, anything else is what yt-dlp was writing when it got interrupted
+            remove_leftovers(track)
+            to_download.append(track)
+        elif (library_file.parent / file).exists():
+            finish(track, library_file.parent / file, journal)
+        else:
+            # Interrupted right after the rename, before it could be recorded
+            journal.record(track, "renamed")
+    return to_download
+
+
+def main(
+    jobs: int = 4,
+    timeout: Optional[float] = 600,
+    retries: int = 2,
+    yt_dlp: str = "yt-dlp",
+    in_process: bool = False,
+):
+    journal = DownloadJournal(cache_directory(library_file.parent) / "download-journal.jsonl")
+    if journal.unfinished():
+        print(f"Resuming interrupted run from {journal.path}")
+        to_download = resume(journal)
+        print(f"Downloading {len(to_download)} remaining tracks")
+        download_all(to_download, jobs=jobs, timeout=timeout, retries=retries, yt_dlp=yt_dlp, journal=journal, in_process=in_process)
+        if not journal.unfinished():
+            journal.clear()
+
+    library = read_library(library_file)
     to_download: list[tuple] = []
     print("Computing tracks to download list")
-    for track in tqdm(library):
+    start = perf_counter()
+    with Catalog.open(library_file.parent) as catalog:
+        downloaded = {(entry.artists, normalize_title(entry.title)) for entry in catalog.entries()}
+    for track in library:
         if len(track) not in (2, 3):
             print(f"{track} format is incorrect")
             continue
-        already_downloaded = False
-
-        for file in library_file.parent.iterdir():
-            if file.name.startswith((" " * 2).join(track)):
-                already_downloaded = True
-                break
-            # if file.name.startswith("⣎⡇ꉺლ"):
-            #     already_downloaded = True
-            #     print(f"{track} already downloaded")
-            #     break
-
-        if not already_downloaded:
+
+        if (track[0], normalize_title(track[1])) not in downloaded:
             to_download.append(track)
 
+    print(f"Planned in {perf_counter() - start:.2f}s")
     print(f"Downloading {len(to_download)} tracks")
 
-    for track in to_download:
-        download(track)
+    downloaded = download_all(to_download, jobs=jobs, timeout=timeout, retries=retries, yt_dlp=yt_dlp, journal=journal, in_process=in_process)
+    print(f"Downloaded {downloaded} tracks")
+    if not journal.unfinished():
+        journal.clear()
 
 
 def duration_from_youtube(id: str) -> float:
@@ -169,18 +433,25 @@ def duration_delta_acceptable(artist: str, title: str, video_id: str) -> bool:
 
 
 def verify_durations():
-    for track in library_file.parent.iterdir():
-        if track.suffix != ".mp3":
-            continue
-        if len(parts := track.name.split("  ")) != 3:
-            continue
-        artist, title, video_id = parts
+    with Catalog.open(library_file.parent) as catalog:
+        entries = catalog.entries()
+    for entry in entries:
+        artist, title, video_id = entry.artists, entry.title, entry.youtube_id
 
         print(
-            f"[{'green' if duration_delta_acceptable(*parts) else 'red'}]{artist}: {title}"
+            f"[{'green' if duration_delta_acceptable(artist, title, video_id) else 'red'}]{artist}: {title}"
         )
 
 
 if __name__ == "__main__":
-    main()
+    args = docopt(__doc__)
+    library_file = Path(args["<library-file>"] or library_file)
+    print(f"Using library file: {library_file}")
+    main(
+        jobs=int(args["--jobs"]),
+        timeout=float(args["--timeout"]),
+        retries=int(args["--retries"]),
+        yt_dlp=args["--yt-dlp"],
+        in_process=args["--in-process"],
+    )
 # TODO: compare metadata tags instead of file names to check if already downloaded, maybe it'll work better
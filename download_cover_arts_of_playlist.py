@@ -1,19 +1,35 @@
 # /// script
-# dependencies = ["docopt", "python-slugify", "requests", "helium", "spotipy", "python-dotenv", "rich"]
+# dependencies = ["docopt", "python-slugify", "requests", "helium", "selenium", "spotipy", "python-dotenv", "rich"]
 # ///
 
 """
 Usage:
-    cover-arts.py SPOTIFY_PLAYLIST_URL SAVE_INTO
+    cover-arts.py [--workers=<n>] [--refresh] SPOTIFY_PLAYLIST_URL SAVE_INTO
 
 SAVE_INTO is always relative to where cover-arts.py is.
+
+Options:
+    --workers=<n>    Number of headless browsers searching for artworks at the same time, and of images downloaded at the same time [default: 4]
+    --refresh        Download again the artworks that changed since they were downloaded, asking the server with ETag / If-Modified-Since
 """
 
 from docopt import docopt
 from slugify import slugify
 import requests
-from helium import *
+from requests.adapters import HTTPAdapter
+from helium import start_chrome
+from concurrent.futures import Future, ThreadPoolExecutor
+from hashlib import sha256
 from pathlib import Path
+from queue import Empty, Queue
+from threading import Lock, Thread
+from typing import Optional
+import json
+import os
+import unicodedata
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
 from rich import print 
@@ -23,63 +39,248 @@ here = Path(__file__).parent
 load_dotenv(here / ".env")
 spotify = spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials())
 
-def download_artwork(query, save_into):
-    save_as = save_into / (slugify(query) + ".png")
-    if save_as.exists():
-        print(f"Skipping {save_as}, which is already downloaded")
-        return
-    print(f"Downloading: {query} (slugified to {save_as.with_suffix('').stem})", end=" ")
-    start_chrome("https://bendodson.com/projects/apple-music-artwork-finder/", headless=True)
-    link = None
-    try:
-        write(query.replace(">", " ").replace("<", " ").replace("(", " ").replace(")", " "), into=S("#query").web_element)
-        click("Get the artwork")
+ARTWORK_FINDER = "https://bendodson.com/projects/apple-music-artwork-finder/"
 
-        wait_until(lambda: not Text("Searching Apple Music albums...").exists())
+# helium keeps the driver it started in a global, so browsers are started one at a time.
+# Each ArtworkFinder only ever uses its own driver afterwards.
+starting_chrome = Lock()
 
-        if Text("No albums found.").exists():
-            kill_browser()
-            print(f"[red][bold] not found on iTunes")
-            return
 
-        link = find_all(S("#results a"))[2].web_element.get_attribute("href") # first 2 links are going to be to standard res. images of first result, second one (what we want) is high-res of first result.
-    except Exception:
-        print()
-    finally:
-        kill_browser()
+class ArtworkFinder:
+    """
+    One headless Chrome, kept open between searches: the page is just reloaded for each one.
+    If the browser or its tab crashes, a new one is started and the search is tried again.
+    """
+
+    def __init__(self) -> None:
+        self.driver = None
+
+    def start(self):
+        with starting_chrome:
+            self.driver = start_chrome(ARTWORK_FINDER, headless=True)
+
+    def quit(self):
+        if self.driver:
+            try:
+                self.driver.quit()
+            except WebDriverException:
+                pass
+            self.driver = None
+
+    def find(self, query: str, tries: int = 2) -> Optional[str]:
+        """
+        Returns the URL of the high-res artwork, None if there's none
+        """
+        for _ in range(tries):
+            try:
+                if not self.driver:
+                    self.start()
+                return self.search(query)
+            except TimeoutException:
+                return None
+            except WebDriverException as e:
+                print(f"[yellow]Browser crashed ({e.msg}), starting a new one")
+                self.quit()
+        return None
+
+    def search(self, query: str) -> Optional[str]:
+        driver = self.driver
+        driver.get(ARTWORK_FINDER)
+        driver.find_element(By.CSS_SELECTOR, "#query").send_keys(
+            query.replace(">", " ").replace("<", " ").replace("(", " ").replace(")", " ")
+        )
+        driver.find_element(By.XPATH, "//*[normalize-space(text())='Get the artwork']").click()
+
+        WebDriverWait(driver, 30).until(
+            lambda driver: "Searching Apple Music albums..." not in driver.find_element(By.TAG_NAME, "body").text
+        )
+
+        if "No albums found." in driver.find_element(By.TAG_NAME, "body").text:
+            return None
+
+        # first 2 links are going to be to standard res. images of first result, second one (what we want) is high-res of first result.
+        links = driver.find_elements(By.CSS_SELECTOR, "#results a")
+        return links[2].get_attribute("href") if len(links) > 2 else None
+
+
+def canonical_slug(slug: str) -> str:
+    """
+    Slugs made by different versions of python-slugify, e.g. voyage-de-la-planete and voyage-de-la-planète, are the same
+    """
+    return unicodedata.normalize("NFKD", slug).encode("ascii", "ignore").decode("ascii").lower()
+
+
+class ArtworkStore:
+    """
+    The images in a directory, and where each of them was downloaded from, in .artworks.json.
+    Images are downloaded by a thread pool sharing one HTTP session, streamed to a temporary file then renamed.
+    An image identical to one already stored is hard-linked to it instead of being written again.
+    """
+
+    directory: Path
+    sources: dict[str, dict]  # file name -> url, etag, last_modified and sha256 of the image
+
+    def __init__(self, directory: Path, workers: int = 4) -> None:
+        self.directory = directory
+        self.manifest = directory / ".artworks.json"
+        self.sources = json.loads(self.manifest.read_text("utf8")) if self.manifest.exists() else {}
+        self.by_slug = {canonical_slug(image.stem): image for image in directory.glob("*.png")}
+        self.by_hash = {
+            source["sha256"]: directory / name
+            for name, source in self.sources.items()
+            if (directory / name).exists()
+        }
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.downloads = ThreadPoolExecutor(workers)
+        self.lock = Lock()
+
+    def path(self, query: str) -> Path:
+        return self.directory / (slugify(query) + ".png")
+
+    def stored(self, query: str) -> Optional[Path]:
+        return self.by_slug.get(canonical_slug(slugify(query)))
+
+    def known_url(self, query: str) -> Optional[str]:
+        stored = self.stored(query)
+        return self.sources.get(stored.name, {}).get("url") if stored else None
+
+    def fetch(self, query: str, link: str) -> Future:
+        return self.downloads.submit(self._fetch, self.stored(query) or self.path(query), link)
 
+    def _fetch(self, save_as: Path, link: str):
+        """
+        Nobody waits on the download's future, so errors are reported here, and the partly downloaded image is removed
+        """
+        temporary = save_as.with_name(f".{save_as.name}.part")
+        try:
+            self._download(save_as, link, temporary)
+        except Exception as e:
+            print(f"[red] {link} failed: {e}")
+            temporary.unlink(missing_ok=True)
+
+    def _download(self, save_as: Path, link: str, temporary: Path):
+        source = self.sources.get(save_as.name, {})
+        headers = {}
+        if save_as.exists() and source.get("url") == link:
+            if source.get("etag"):
+                headers["If-None-Match"] = source["etag"]
+            if source.get("last_modified"):
+                headers["If-Modified-Since"] = source["last_modified"]
+
+        digest = sha256()
+        with self.session.get(link, headers=headers, stream=True, timeout=60) as response:
+            if response.status_code == 304:
+                print(f"[dim]{save_as.name} didn't change")
+                return
+            if response.status_code != 200:
+                print(f"[red]Couldn't download {link}: HTTP {response.status_code}")
+                return
+            with temporary.open("wb") as image_file:
+                for chunk in response.iter_content(64 * 1024):
+                    digest.update(chunk)
+                    image_file.write(chunk)
+            etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+
+        with self.lock:
+            same = self.by_hash.get(digest.hexdigest())
+            if same and same != save_as and same.exists():
+                print(f"{save_as.name} is the same image as {same.name}, linking them")
+                temporary.unlink()
+                save_as.unlink(missing_ok=True)
+                os.link(same, save_as)
+            else:
+                temporary.replace(save_as)
+                self.by_hash[digest.hexdigest()] = save_as
+            self.by_slug[canonical_slug(save_as.stem)] = save_as
+            self.sources[save_as.name] = {
+                "url": link,
+                "etag": etag,
+                "last_modified": last_modified,
+                "sha256": digest.hexdigest(),
+            }
+
+    def close(self):
+        """
+        Waits for downloads to finish, and saves .artworks.json
+        """
+        self.downloads.shutdown(wait=True)
+        self.session.close()
+        temporary = self.manifest.with_suffix(".tmp")
+        temporary.write_text(json.dumps(self.sources, ensure_ascii=False, indent=2, sort_keys=True), encoding="utf8")
+        temporary.replace(self.manifest)
+
+
+def download_artwork(query, store: ArtworkStore, finder: ArtworkFinder):
+    if stored := store.stored(query):
+        print(f"Skipping {stored}, which is already downloaded")
+        return
+
+    link = finder.find(query)
     if not link:
-        print(f"Couldn't get {query}'s artwork image URL")
-        return 
+        print(f"[red]Couldn't get {query}'s artwork image URL [dim](slugified to {store.path(query).stem})")
+        return
 
-    print(f"-> {link} -> {save_as}")
-    image_response = requests.get(link)
+    print(f"Downloading: {query} -> {link} -> {store.path(query)}")
+    store.fetch(query, link)
 
-    if image_response.status_code == 200:
-        with open(str(save_as), "wb") as image_file:
-            image_file.write(image_response.content)
 
-def download_artworks(playlist_url, save_into):
-    response = spotify.playlist_tracks(playlist_url)["items"]
+def download_all_artworks(queries: list[str], save_into: Path, workers: int = 4, refresh: bool = False):
+    """
+    Each worker keeps its own browser open while it takes queries off a shared queue.
+    Images are downloaded in the background, so that browsers can go on searching meanwhile.
+    """
+    store = ArtworkStore(save_into, workers)
+    queue = Queue()
+    for query in queries:
+        if not store.stored(query):
+            queue.put(query)
+        elif refresh and (url := store.known_url(query)):
+            store.fetch(query, url)
+
+    def work():
+        finder = ArtworkFinder()
+        try:
+            while True:
+                try:
+                    query = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    download_artwork(query, store, finder)
+                except Exception as e:
+                    print(f"[red] {query} failed: {e}")
+        finally:
+            finder.quit()
+
+    threads = [Thread(target=work) for _ in range(min(workers, queue.qsize()))]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        store.close()
+
+
+def download_artworks(playlist_url, save_into, workers: int = 4, refresh: bool = False):
+    results = spotify.playlist_tracks(playlist_url)
+    items = results["items"]
+    while results["next"]:
+        results = spotify.next(results)
+        items += results["items"]
+
     to_track = lambda i: ( i["track"]["album"]["artists"][0]["name"], i["track"]["album"]["name"] )
-    tracks: set[tuple[str, str]] = { to_track(i) for i in response }
-    
-    offset = 0
-    while len(response) >= 50:
-        offset += 1
-        response = spotify.playlist_tracks(playlist_url, offset=offset)["items"]
-        tracks |= { to_track(i) for i in response }
+    tracks: set[tuple[str, str]] = { to_track(i) for i in items if i.get("track") }
 
     print("Will download cover arts for:", tracks )
         
-    for (artist, album) in tracks:
-        try:
-            download_artwork(f"{artist} {album}", save_into)
-        except Exception as e:
-            print(f"[red] {artist} - {album} failed: {e}")
+    download_all_artworks([f"{artist} {album}" for (artist, album) in tracks], save_into, workers, refresh)
 
 if __name__ == "__main__":
     args = docopt(__doc__)
     save_into = here / args["SAVE_INTO"]
     playlist_url = args["SPOTIFY_PLAYLIST_URL"]
-    download_artworks(playlist_url, save_into)
+    download_artworks(playlist_url, save_into, int(args["--workers"]), args["--refresh"])
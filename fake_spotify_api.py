@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the parts of the Spotify Web API that backup.py and spotify-backup.py use, with made-up data.
+
+    python fake_spotify_api.py --port 8765 --throttle-every 10
+    SPOTIFY_API_URL=http://127.0.0.1:8765/v1/ python backup.py
+
+Can inject rate limiting (429 with Retry-After) and server errors, to see how clients cope with them.
+"""
+
+from argparse import ArgumentParser
+from datetime import datetime, timedelta, timezone
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import sleep
+from urllib.parse import parse_qs, urlencode, urlparse
+import json
+
+
+class FakeSpotify:
+    playlists: int
+    tracks_per_playlist: int
+    liked_tracks: int
+    throttle_every: int
+    retry_after: int
+    fail_every: int
+    latency: float
+
+    def __init__(
+        self,
+        playlists: int = 5,
+        tracks_per_playlist: int = 250,
+        liked_tracks: int = 500,
+        throttle_every: int = 0,
+        retry_after: int = 1,
+        fail_every: int = 0,
+        latency: float = 0,
+    ) -> None:
+        self.playlists = playlists
+        self.tracks_per_playlist = tracks_per_playlist
+        self.liked_tracks = liked_tracks
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.fail_every = fail_every
+        self.latency = latency
+        self.requests = 0
+        self._lock = Lock()
+
+    def count_request(self) -> int:
+        with self._lock:
+            self.requests += 1
+            return self.requests
+
+    @staticmethod
+    def track(seed: str, i: int) -> dict:
+        id = md5(f"{seed}{i}".encode()).hexdigest()[:22]
+        return {
+            "id": id,
+            "uri": f"spotify:track:{id}",
+            "name": f"Track {i} of {seed}",
+            "artists": [{"name": f"Artist {i % 17}"}],
+            "album": {
+                "name": f"Album {i % 5}",
+                "uri": f"spotify:album:{i % 5}",
+                "release_date": "2020-01-01",
+                "artists": [{"name": f"Artist {i % 17}"}],
+            },
+        }
+
+    def playlist(self, base: str, id: str) -> dict:
+        return {
+            "id": id,
+            "name": f"Playlist {id}",
+            "owner": {"id": "fake-user"},
+            "snapshot_id": md5(f"{id}{self.tracks_per_playlist}".encode()).hexdigest(),
+            "external_urls": {"spotify": f"https://open.spotify.com/playlist/{id}"},
+            "tracks": {"href": f"{base}playlists/{id}/tracks", "total": self.tracks_per_playlist},
+        }
+
+    def page(self, base: str, path: str, items: list, offset: int, limit: int, **extra) -> dict:
+        next_offset = offset + limit
+        return {
+            "items": items[offset:next_offset],
+            "total": len(items),
+            "offset": offset,
+            "limit": limit,
+            "next": f"{base}{path}?{urlencode({'offset': next_offset, 'limit': limit})}" if next_offset < len(items) else None,
+            **extra,
+        }
+
+    def respond(self, base: str, path: str, query: dict) -> tuple[int, dict]:
+        offset = int(query.get("offset", ["0"])[0])
+        limit = int(query.get("limit", ["20"])[0])
+        parts = path.strip("/").split("/")
+
+        if parts == ["me"]:
+            return 200, {"id": "fake-user", "display_name": "Fake User"}
+        if parts in (["me", "playlists"], ["users", "fake-user", "playlists"]):
+            playlists = [self.playlist(base, f"fakeplaylist{i}") for i in range(self.playlists)]
+            return 200, self.page(base, path, playlists, offset, limit)
+        if parts == ["me", "tracks"]:
+            now = datetime(2026, 1, 1, tzinfo=timezone.utc)
+            liked = [
+                {"added_at": (now - timedelta(hours=i)).isoformat().replace("+00:00", "Z"), "track": self.track("liked", i)}
+                for i in range(self.liked_tracks)
+            ]
+            return 200, self.page(base, path, liked, offset, limit)
+        if parts == ["me", "albums"]:
+            albums = [{"album": self.track("album", i)["album"] | {"name": f"Album {i}"}} for i in range(self.liked_tracks // 10)]
+            return 200, self.page(base, path, albums, offset, limit)
+        if len(parts) == 2 and parts[0] == "playlists":
+            return 200, self.playlist(base, parts[1])
+        if len(parts) == 3 and parts[0] == "playlists" and parts[2] == "tracks":
+            items = [{"track": self.track(parts[1], i)} for i in range(self.tracks_per_playlist)]
+            return 200, self.page(base, path, items, offset, limit)
+        return 404, {"error": {"status": 404, "message": "Not found"}}
+
+
+def handler(fake: FakeSpotify):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive
+
+        def do_GET(self):
+            count = fake.count_request()
+            sleep(fake.latency)
+            url = urlparse(self.path)
+            if fake.throttle_every and count % fake.throttle_every == 0:
+                return self.reply(429, {"error": {"status": 429, "message": "API rate limit exceeded"}}, {"Retry-After": str(fake.retry_after)})
+            if fake.fail_every and count % fake.fail_every == 0:
+                return self.reply(503, {"error": {"status": 503, "message": "Service unavailable"}})
+            if not url.path.startswith("/v1/"):
+                return self.reply(404, {"error": {"status": 404, "message": "Not found"}})
+            base = f"http://{self.headers['Host']}/v1/"
+            status, body = fake.respond(base, url.path.removeprefix("/v1/"), parse_qs(url.query))
+            self.reply(status, body)
+
+        def reply(self, status: int, body: dict, headers: dict = {}):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    Handler.fake = fake
+    return Handler
+
+
+def serve_in_background(port: int = 0, **options) -> tuple[ThreadingHTTPServer, str]:
+    """
+    Returns the server and its base URL, e.g. http://127.0.0.1:41234/v1/
+    The FakeSpotify it serves is server.RequestHandlerClass.fake
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler(FakeSpotify(**options)))
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1/"
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--playlists", type=int, default=5)
+    parser.add_argument("--tracks-per-playlist", type=int, default=250)
+    parser.add_argument("--liked-tracks", type=int, default=500)
+    parser.add_argument("--throttle-every", type=int, default=0, help="answer every Nth request with a 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After of 429 responses, in seconds")
+    parser.add_argument("--fail-every", type=int, default=0, help="answer every Nth request with a 503")
+    parser.add_argument("--latency", type=float, default=0, help="seconds to wait before answering each request")
+    args = parser.parse_args()
+    options = vars(args)
+    port = options.pop("port")
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler(FakeSpotify(**options)))
+    print(f"Serving a fake Spotify API on http://127.0.0.1:{port}/v1/")
+    server.serve_forever()
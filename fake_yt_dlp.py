@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Stand-in for yt-dlp that doesn't touch the network, to try out download.py offline:
+
+    python download.py --yt-dlp "python fake_yt_dlp.py --fake-delay 2" some-library.tsv
+
+Understands the subset of yt-dlp's options that download.py uses, and writes a tiny mp3 file (just an ID3 header) to the --output template.
+Can also be used as a module in place of yt_dlp's Python API, see parse_options and YoutubeDL.
+"""
+
+from argparse import ArgumentParser
+from hashlib import md5
+from pathlib import Path
+from time import sleep
+from typing import NamedTuple
+import random
+import sys
+
+# An ID3v2.4 tag with a single TSSE (encoder settings) frame, so that mutagen can tag the file.
+_TSSE = b"\x03fake-yt-dlp"
+FAKE_MP3 = (
+    b"ID3\x04\x00\x00"
+    + (10 + len(_TSSE)).to_bytes(4, "big")
+    + b"TSSE"
+    + len(_TSSE).to_bytes(4, "big")
+    + b"\x00\x00"
+    + _TSSE
+)
+
+
+def video_id(query: str) -> str:
+    """
+    A stable, YouTube-looking id for a query
+    """
+    return md5(query.encode("utf-8")).hexdigest()[:11]
+
+
+def fake_download(query: str, output: str) -> Path:
+    file = Path(output.replace("%(id)s", video_id(query)))
+    file.write_bytes(FAKE_MP3)
+    return file
+
+
+class ParsedOptions(NamedTuple):
+    urls: list[str]
+    ydl_opts: dict
+
+
+def parse_options(argv: list[str]) -> ParsedOptions:
+    parser = ArgumentParser(prog="fake_yt_dlp.py")
+    parser.add_argument("urls", nargs="*")
+    parser.add_argument("--output", "-o")
+    for option in ("--remote-components", "--audio-format", "--max-downloads", "--age-limit"):
+        parser.add_argument(option)
+    parser.add_argument("--quiet", "-q", action="store_true")
+    parser.add_argument("--fake-startup", type=float, default=0, help="seconds to sleep when starting up, like yt-dlp loading its extractors")
+    parser.add_argument("--fake-delay", type=float, default=0, help="seconds to sleep before 'downloading'")
+    parser.add_argument("--fake-fail-rate", type=float, default=0, help="probability of failing, without downloading anything")
+    parser.add_argument("--fake-missing", default="", help="queries containing this string are not found")
+    args, _ = parser.parse_known_args(argv)
+    return ParsedOptions(
+        urls=args.urls,
+        ydl_opts={
+            "outtmpl": {"default": args.output},
+            "quiet": args.quiet,
+            "fake_startup": args.fake_startup,
+            "fake_delay": args.fake_delay,
+            "fake_fail_rate": args.fake_fail_rate,
+            "fake_missing": args.fake_missing,
+        },
+    )
+
+
+class YoutubeDL:
+    """
+    Mimics the parts of yt_dlp.YoutubeDL that download.py uses
+    """
+
+    params: dict
+
+    def __init__(self, params: dict) -> None:
+        self.params = params
+        sleep(params.get("fake_startup", 0))
+
+    def __enter__(self) -> "YoutubeDL":
+        return self
+
+    def __exit__(self, *_) -> None:
+        pass
+
+    def download(self, urls: list[str]) -> int:
+        returncode = 0
+        for url in urls:
+            sleep(self.params.get("fake_delay", 0))
+            if random.random() < self.params.get("fake_fail_rate", 0):
+                print(f"ERROR: [fake] simulated failure for {url!r}", file=sys.stderr)
+                returncode = 1
+                continue
+            if self.params.get("fake_missing") and self.params["fake_missing"] in url:
+                continue
+            file = fake_download(url, self.params["outtmpl"]["default"])
+            if not self.params.get("quiet"):
+                print(f"[fake] Destination: {file}")
+        return returncode
+
+
+def main(argv: list[str]) -> int:
+    urls, ydl_opts = parse_options(argv)
+    with YoutubeDL(ydl_opts) as ydl:
+        if returncode := ydl.download(urls):
+            return returncode
+    return 101  # like yt-dlp when --max-downloads is reached
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
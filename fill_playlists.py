@@ -1,21 +1,29 @@
 #!/usr/bin/env python
 import re
 from itertools import chain
+from functools import cache
 from pathlib import Path
 from subprocess import run
 import subprocess
+import shlex
+import os
+from concurrent.futures import ThreadPoolExecutor
 from sys import stderr
-from time import sleep
+from time import sleep, perf_counter
+from datetime import datetime, timedelta
+from collections import defaultdict
+from hashlib import sha256
 import requests
 import json
 import yaml
 from bs4 import BeautifulSoup
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
-from typing import NamedTuple, Iterable, Optional, Union
+from typing import Callable, NamedTuple, Iterable, Optional, Union
 from rich import print
 from dotenv import load_dotenv
 from download import download
+from library import Catalog, Track, LibraryIndex, cache_directory
 
 
 here = Path(__file__).parent
@@ -23,64 +31,68 @@ load_dotenv(here / ".env")
 spotify = spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials())
 
 
-class Track:
-    title: str
-    artists: set[str]
-    youtube_source_video_id: str
-    filepath: Path
+# How long the tracklist.tsv saved by backup.py is trusted without asking Spotify if the playlist changed
+TRACKLIST_TTL = timedelta(hours=12)
 
-    def __init__(
-        self,
-        filepath: Path,
-        title: str = "",
-        artists: set[str] = set(),
-        youtube_source_video_id: Optional[str] = None,
-    ) -> None:
-        self.title = title
-        self.artists = artists
-        self.filepath = filepath
-        self.artists = set(
-            self.artists or self.filepath.name.split("  ")[0].split(", ")
-        )
-        self.youtube_source_video_id = (
-            youtube_source_video_id or self.filepath.name.split("  ")[2]
+
+def read_tracklist(tracklist: Path) -> list[tuple[set[str], str]]:
+    return [
+        (set(artists.split(", ")), title)
+        for artists, title, *_ in (
+            line.split("\t") for line in tracklist.read_text("utf8").splitlines()[1:] if "\t" in line
         )
+    ]
 
-    @property
-    def remixed(self) -> bool:
-        return len(self.artists) >= 2 and "remix" in map(str.lower, list(self.title))
 
-    def __str__(self) -> str:
-        return f"{', '.join(self.artists)} — {self.title}"
+def fetch_tracklist(url: str) -> list[tuple[set[str], str]]:
+    results = spotify.playlist_items(url, additional_types=("track",))
+    items = results["items"]
+    while results["next"]:
+        results = spotify.next(results)
+        items.extend(results["items"])
+    return [
+        (set(a["name"] for a in item["track"]["artists"]), item["track"]["name"])
+        for item in items
+        if item.get("track")
+    ]
 
-    __repr__ = __str__
 
+def playlist_rows(url: str, directory: Optional[Path]) -> list[tuple[set[str], str]]:
+    """
+    Returns the (artists, title) of the playlist's tracks, from the tracklist.tsv backup.py keeps in directory when possible.
+    Spotify is only asked for the playlist's snapshot_id once the tracklist is older than TRACKLIST_TTL,
+    and the playlist is only fetched from Spotify when that snapshot_id isn't the one the tracklist was saved from.
+    """
+    tracklist = directory / "tracklist.tsv" if directory else None
+    if not tracklist or not tracklist.exists():
+        return fetch_tracklist(url)
 
-def find_file_of_track(library: Iterable[Path], artists: set[str], title: str) -> Path:
-    for track in library:
-        t_artists_str, t_title, *_ = track.name.split("  ")
-        t_title = t_title.replace('∕', '/')
-        t_artists = set(t_artists_str.split(', '))
-        if title.strip() == t_title.strip():
-            return track
-    raise KeyError(
-        f"No file found in given library ({[f.name for f in library]}) for track {artists}\t{title}"
-    )
+    if datetime.fromtimestamp(tracklist.stat().st_mtime) + TRACKLIST_TTL > datetime.now():
+        return read_tracklist(tracklist)
 
+    snapshot_file = directory / "tracklist.snapshot_id"
+    try:
+        snapshot_id = spotify.playlist(url, fields="snapshot_id")["snapshot_id"]
+    except Exception as e:
+        print(f" [yellow]⚠  Couldn't check if {url} changed, using {tracklist}: {e}", file=stderr)
+        return read_tracklist(tracklist)
 
-def from_spotify_playlist(url: str) -> set[Track]:
-    tracks_raw = [item["track"] for item in spotify.playlist_tracks(url)["items"]]
-    tracks = set()
+    if snapshot_file.exists() and snapshot_file.read_text("utf8").strip() == snapshot_id:
+        tracklist.touch()
+        return read_tracklist(tracklist)
 
-    for t in tracks_raw:
-        title = t["name"]
-        artists = set(a["name"] for a in t["artists"])
+    return fetch_tracklist(url)
 
+
+def from_spotify_playlist(url: str, index: LibraryIndex, directory: Optional[Path] = None) -> set[Track]:
+    """
+    directory is where the playlist's autofill.yaml is, see playlist_rows
+    """
+    tracks = set()
+
+    for artists, title in playlist_rows(url, directory):
         try:
-            filepath = find_file_of_track(
-                [t.filepath for t in all_tracks()], artists=artists, title=title
-            )
-            tracks.add(Track(filepath=filepath))
+            tracks.add(index.find(artists, title))
 
         except KeyError:
             print(
@@ -98,47 +110,93 @@ class ContainConstraint(NamedTuple):
     regex: str = ""  # regular expression
     raw: str = ""  # a plain string
 
-    CJK_CHARACTERS = [
-        range(ord("\u3300"), ord("\u33ff")),  # compatibility ideographs
-        range(ord("\ufe30"), ord("\ufe4f")),  # compatibility ideographs
-        range(ord("\uf900"), ord("\ufaff")),  # compatibility ideographs
-        range(ord("\U0002F800"), ord("\U0002fa1f")),  # compatibility ideographs
-        range(ord("\u3040"), ord("\u309f")),  # Japanese Hiragana
-        range(ord("\u30a0"), ord("\u30ff")),  # Japanese Katakana
-        range(ord("\u2e80"), ord("\u2eff")),  # cjk radicals supplement
-        range(ord("\u4e00"), ord("\u9fff")),
-        range(ord("\u3400"), ord("\u4dbf")),
-        range(ord("\U00020000"), ord("\U0002a6df")),
-        range(ord("\U0002a700"), ord("\U0002b73f")),
-        range(ord("\U0002b740"), ord("\U0002b81f")),
-        range(ord("\U0002b820"), ord("\U0002ceaf")),  # included as of Unicode 8.0
+    # Inclusive (first, last) code point ranges
+    HAN_CHARACTERS = [
+        (0x2E80, 0x2EFF),  # cjk radicals supplement
+        (0x2F00, 0x2FDF),  # kangxi radicals
+        (0x3005, 0x3007),  # iteration mark, closing mark, ideographic zero
+        (0x3300, 0x33FF),  # compatibility
+        (0x3400, 0x4DBF),  # extension A
+        (0x4E00, 0x9FFF),  # unified ideographs
+        (0xF900, 0xFAFF),  # compatibility ideographs
+        (0xFE30, 0xFE4F),  # compatibility forms
+        (0x20000, 0x2A6DF),  # extension B
+        (0x2A700, 0x2B73F),  # extension C
+        (0x2B740, 0x2B81F),  # extension D
+        (0x2B820, 0x2CEAF),  # extension E, included as of Unicode 8.0
+        (0x2CEB0, 0x2EBEF),  # extension F
+        (0x2F800, 0x2FA1F),  # compatibility ideographs supplement
+        (0x30000, 0x3134F),  # extension G
+    ]
+    KANA_CHARACTERS = [
+        (0x3040, 0x309F),  # hiragana
+        (0x30A0, 0x30FF),  # katakana
+        (0x31F0, 0x31FF),  # katakana phonetic extensions
+        (0xFF66, 0xFF9F),  # halfwidth katakana
+    ]
+    HANGUL_CHARACTERS = [
+        (0x1100, 0x11FF),  # jamo
+        (0x3130, 0x318F),  # compatibility jamo
+        (0xA960, 0xA97F),  # jamo extended A
+        (0xAC00, 0xD7AF),  # syllables
+        (0xD7B0, 0xD7FF),  # jamo extended B
+        (0xFFA0, 0xFFDC),  # halfwidth jamo
     ]
+    CHARACTER_SETS = {
+        "japanese characters": HAN_CHARACTERS + KANA_CHARACTERS,
+        "chinese characters": HAN_CHARACTERS,
+        "korean characters": HANGUL_CHARACTERS,
+        "cjk characters": HAN_CHARACTERS + KANA_CHARACTERS + HANGUL_CHARACTERS,
+    }
 
     def matches_set(self, string: str) -> bool:
+        """
+        Whether string contains at least one character of the set
+        """
         if self.set == "":
             return False
-        elif self.set in {
-            "japanese characters",
-            "chinese characters",
-            "korean characters",
-            "cjk characters",
-        }:
-            print("TODO: CJK matching")
-            # TODO: CJK matching
-            return False
-            for r in self.CJK_CHARACTERS:
-                if set(map(ord, set(string))) ^ set(r):
-                    return True
-            return False
-        else:
-            raise ValueError(f"Unknown character set {self.set!r}")
+        return character_class(self.set).search(string) is not None
+
+    def compile(self) -> Callable[[str], bool]:
+        """
+        Returns a function equivalent to matches, that doesn't need to look at the constraint anymore
+        """
+        checks: list[Callable[[str], bool]] = []
+        if self.raw:
+            checks.append(self.raw.__eq__)
+        if self.regex:
+            match = re.compile(self.regex).match
+            checks.append(lambda string: match(string) is not None)
+        if self.set:
+            search = character_class(self.set).search
+            checks.append(lambda string: search(string) is not None)
+
+        if not checks:
+            return lambda string: False
+        if len(checks) == 1:
+            return checks[0]
+        return lambda string: any(check(string) for check in checks)
 
     def matches(self, string: str) -> bool:
-        return (
-            string == self.raw
-            or bool(re.compile(self.regex).match(string))
-            # or self.matches_set(string)
-        )
+        return self.compile()(string)
+
+
+@cache
+def character_class(name: str) -> re.Pattern:
+    """
+    Compiles a predefined character set of ContainConstraint into a regex character class, built from its sorted and merged ranges
+    """
+    if name not in ContainConstraint.CHARACTER_SETS:
+        raise ValueError(f"Unknown character set {name!r}")
+    merged: list[list[int]] = []
+    for first, last in sorted(ContainConstraint.CHARACTER_SETS[name]):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    return re.compile(
+        "[" + "".join(f"{re.escape(chr(first))}-{re.escape(chr(last))}" for first, last in merged) + "]"
+    )
 
 
 class MetadataConstraint:
@@ -156,6 +214,160 @@ class MetadataConstraint:
     def matches(self, metadata_piece: str) -> bool:
         return self.contain.matches(metadata_piece)
 
+    def compile(self) -> Callable[[str], bool]:
+        return self.contain.compile()
+
+
+def runs_command(command: str, track: Track) -> str:
+    """
+    Fills in {track} ("artists — title") and {path} (the track's file) in a runs: command, quoted for the shell
+    """
+    return command.format(track=shlex.quote(str(track)), path=shlex.quote(str(track.filepath)))
+
+
+def run_predicate(command: str, track: Track, timeout: Optional[float] = 60) -> bool:
+    """
+    Whether the runs: command exits with 0 for that track. Commands that time out count as not matching.
+    """
+    try:
+        return subprocess.run(runs_command(command, track), shell=True, timeout=timeout).returncode == 0
+    except subprocess.TimeoutExpired:
+        print(f"[yellow]⚠  {runs_command(command, track)!r} timed out", file=stderr)
+        return False
+
+
+class PredicateRunner:
+    """
+    Runs the runs: commands of playlists on many tracks at once, in a bounded pool of processes.
+    Results are cached on (command, track file name, track file mtime), so tracks are only checked again when their file changes.
+    Batch commands get the paths of all tracks to check on stdin, one per line, and print the paths of those matching.
+    Like grep, they may exit with 1 when none match: only a timeout or an exit status above 1 counts as a failure, whose results aren't cached.
+    """
+
+    cache_path: Optional[Path]
+    cache: dict[str, bool]
+
+    def __init__(
+        self, cache_path: Optional[Path] = None, jobs: Optional[int] = None, timeout: Optional[float] = 60
+    ) -> None:
+        self.cache_path = cache_path
+        self.cache = json.loads(cache_path.read_text("utf8")) if cache_path and cache_path.exists() else {}
+        self.jobs = jobs or os.cpu_count()
+        self.timeout = timeout
+
+    @staticmethod
+    def key(command: str, track: Track) -> str:
+        return "\0".join([command, track.filepath.name, str(track.filepath.stat().st_mtime_ns)])
+
+    def filter(self, command: str, tracks: list[Track], batch: bool = False) -> list[Track]:
+        """
+        Returns the tracks for which the command matches, in the same order
+        """
+        keys = {track.filepath: self.key(command, track) for track in tracks}
+        unknown = [track for track in tracks if keys[track.filepath] not in self.cache]
+        if unknown and batch:
+            self.cache.update(
+                {keys[track.filepath]: matched for track, matched in self._run_batch(command, unknown).items()}
+            )
+        elif unknown:
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                results = pool.map(lambda track: run_predicate(command, track, self.timeout), unknown)
+                self.cache.update({keys[track.filepath]: matched for track, matched in zip(unknown, results)})
+        return [track for track in tracks if self.cache.get(keys[track.filepath])]
+
+    def _run_batch(self, command: str, tracks: list[Track]) -> dict[Track, bool]:
+        try:
+            process = subprocess.run(
+                command,
+                shell=True,
+                input="\n".join(str(track.filepath) for track in tracks),
+                capture_output=True,
+                text=True,
+                timeout=self.timeout and self.timeout * len(tracks),
+            )
+        except subprocess.TimeoutExpired:
+            print(f"[yellow]⚠  {command!r} timed out", file=stderr)
+            return {}
+        if process.returncode > 1:
+            print(f"[yellow]⚠  {command!r} exited with {process.returncode}: {process.stderr}", file=stderr)
+            return {}
+        matching = set(process.stdout.splitlines())
+        return {track: str(track.filepath) in matching for track in tracks}
+
+    def save(self):
+        if not self.cache_path:
+            return
+        temporary = self.cache_path.with_suffix(".tmp")
+        temporary.write_text(json.dumps(self.cache, ensure_ascii=False), encoding="utf8")
+        temporary.replace(self.cache_path)
+
+
+class CompiledPlaylistSpec:
+    """
+    Everything PlaylistSpec.matches needs, computed once: frozen sets, precompiled constraints,
+    and checks ordered from cheapest to most expensive so that most tracks are rejected early.
+    """
+
+    def __init__(self, spec: "PlaylistSpec") -> None:
+        self.artists = frozenset(spec.artists)
+        self.tracks_artists: dict[str, frozenset[str]] = {}
+        for track in spec.tracks:
+            self.tracks_artists[track.title] = self.tracks_artists.get(
+                track.title, frozenset()
+            ) | frozenset(track.artists)
+        self.titles = tuple(c.compile() for c in spec.titles)
+        self.artist_names = tuple(c.compile() for c in spec.artist_names)
+        self.remixes = spec.remixes
+        self.except_ = frozenset(
+            (frozenset(artists.split(", ")), title) for artists, title in spec.except_
+        )
+        self.runs = spec.runs
+        self.runs_batch = spec.runs_batch
+        self.runner = PredicateRunner()
+
+    def selects(self, track: Track) -> bool:
+        """
+        Whether the track is by one of artists, is one of tracks, or satisfies titles or artist_names
+        """
+        artists = track.artists
+        if not self.artists.isdisjoint(artists):
+            return True
+        if (by_title := self.tracks_artists.get(track.title)) and not by_title.isdisjoint(artists):
+            return True
+        if self.titles and any(match(track.title) for match in self.titles):
+            return True
+        if self.artist_names:
+            return any(match(artist) for match in self.artist_names for artist in artists)
+        return False
+
+    def matches(self, track: Track, runs: bool = True) -> bool:
+        """
+        With runs unset, runs: commands aren't executed, see run_commands to run them on many tracks at once.
+        A runs batch: command is run on this track alone (results are cached in self.runner), prefer pick_from or pick_all for many tracks.
+        """
+        if not self.selects(track):
+            return False
+        if not self.remixes and track.remixed:
+            return False
+        if self.except_ and (frozenset(track.artists), track.title) in self.except_:
+            return False
+        if runs and self.runs and not run_predicate(self.runs, track):
+            return False
+        if runs and self.runs_batch:
+            return bool(self.runner.filter(self.runs_batch, [track], batch=True))
+        return True
+
+    def run_commands(self, tracks: list[Track], runner: Optional[PredicateRunner] = None) -> list[Track]:
+        """
+        The tracks for which runs: and runs batch: commands match, each command being run on all tracks at once
+        """
+        runner = runner or self.runner
+        if self.runs:
+            tracks = runner.filter(self.runs, tracks)
+        if self.runs_batch:
+            tracks = runner.filter(self.runs_batch, tracks, batch=True)
+        return tracks
+
 
 class PlaylistSpec(NamedTuple):
     directory: Path
@@ -168,12 +380,22 @@ class PlaylistSpec(NamedTuple):
     artist_names: set[MetadataConstraint] = set()
     name: str = ""
     runs: str = ""
+    runs_batch: str = ""
+    compiled: Optional[CompiledPlaylistSpec] = None
 
     @classmethod
-    def from_yaml(cls, filepath: Path) -> "PlaylistSpec":
+    def from_yaml(
+        cls, filepath: Path, index: Optional[LibraryIndex] = None, fetch_from: bool = True
+    ) -> "PlaylistSpec":
+        """
+        index is used to resolve tracks: and from: entries, build it once with LibraryIndex.of_directory() when loading several specs.
+        from: playlists are only fetched from Spotify if fetch_from is set.
+        """
+        if index is None:
+            index = LibraryIndex.of_directory(here)
         spec = yaml.safe_load(filepath.read_text("UTF-8"))
         if "except" in spec:
-            spec["except_"] = set(spec["except"])
+            spec["except_"] = set(map(tuple, spec["except"]))
             del spec["except"]
         if "artists" in spec:
             spec["artists"] = set(spec["artists"])
@@ -183,13 +405,7 @@ class PlaylistSpec(NamedTuple):
                     f"tracks: tracks should have at least an artist and a title"
                 )
             spec["tracks"] = set(
-                Track(
-                    filepath=find_file_of_track(
-                        [f.filepath for f in all_tracks()],
-                        artists=set(t[:-1]),
-                        title=t[-1],
-                    )
-                )
+                index.find(artists=set(t[:-1]), title=t[-1])
                 for t in spec["tracks"]
                 if len(t) >= 2
             )
@@ -199,8 +415,8 @@ class PlaylistSpec(NamedTuple):
             url = str(spec["from"])
             spec["from_"] = url
             del spec["from"]
-            if url.startswith("https://open.spotify.com/playlist/"):
-                spec["tracks"] |= from_spotify_playlist(url)
+            if fetch_from and url.startswith("https://open.spotify.com/playlist/"):
+                spec["tracks"] |= from_spotify_playlist(url, index, filepath.parent)
         if "titles" in spec:
             if isinstance(spec["titles"], list):
                 spec["titles"] = set(
@@ -218,83 +434,212 @@ class PlaylistSpec(NamedTuple):
             spec["artist_names"] = spec["artist names"]
             del spec["artist names"]
 
+        if "runs batch" in spec:
+            spec["runs_batch"] = spec["runs batch"]
+            del spec["runs batch"]
+
         if "directory" not in spec:
             spec["directory"] = filepath.parent
 
         spec["directory"] = Path(spec["directory"])
 
         print(cls(**spec))
-        return cls(**spec)
+        return cls(**spec).compile()
 
-    def matches(self, track: Track) -> bool:
-        matches = {
-            "artists": self.artists & track.artists != set(),
-            "track": any(
-                t.artists & track.artists and t.title == track.title
-                for t in self.tracks
-            ),
-            #             "titles": any(
-            #                 constraint.matches(track.title) for constraint in self.titles
-            #             ),
-            "artist_names": any(
-                constraint.matches(track.title) for constraint in self.artist_names
-            ),
-        }
-        conditions = {
-            "remixes": self.remixes or not track.remixed,
-            "except": not (", ".join(track.artists), track.title) in self.except_,
-            "runs": subprocess.run(self.runs.format(track=track)).returncode == 0
-            if self.runs
-            else True,
-        }
-
-        # print(f"{track} \t {' '.join( '{0} {1}'.format(k, v) for k, v in (matches|conditions).items())}")
-        return any(matches.values()) and all(conditions.values())
-
-    def pick_from(self, library: Iterable[Track]) -> Iterable[Track]:
-        return filter(self.matches, library)
+    def compile(self) -> "PlaylistSpec":
+        return self._replace(compiled=CompiledPlaylistSpec(self))
 
-    def m3u(self, library: Iterable[Track]) -> str:
+    def matches(self, track: Track) -> bool:
+        """
+        A track matches if it's by one of artists, is one of tracks, has a title satisfying titles or an artist name satisfying artist_names,
+        and isn't a remix (unless remixes is set), isn't one of except_ and makes runs exit with 0 (if set).
+        runs can use {track} and {path}. runs_batch is given the paths of many tracks on stdin and prints those matching, see PredicateRunner.
+        """
+        return (self.compiled or CompiledPlaylistSpec(self)).matches(track)
+
+    def pick_from(self, library: Iterable[Track], runner: Optional[PredicateRunner] = None) -> list[Track]:
+        """
+        runs: and runs batch: commands are executed once every other check is done, on all the tracks that passed them at once
+        """
+        compiled = self.compiled or CompiledPlaylistSpec(self)
+        return compiled.run_commands([track for track in library if compiled.matches(track, runs=False)], runner)
+
+    def m3u(self, tracks: Iterable[Track]) -> str:
+        """
+        tracks should already be picked, see pick_from and pick_all
+        """
         return (
             "#EXTM3U\n"
             + (f"#PLAYLIST:{self.name}\n" if self.name else "")
-            + "\n".join(str(self.directory / track.filepath.name) for track in self.pick_from(library))
+            + "\n".join(str(self.directory / track.filepath.name) for track in tracks)
         )
 
 
-def autofill(playlist: PlaylistSpec, tracks: list[Track]) -> Iterable[tuple[Track, Path]]:
+def pick_all(
+    playlists: list[PlaylistSpec],
+    library: Iterable[Track],
+    runner: Optional[PredicateRunner] = None,
+) -> tuple[list[list[Track]], list[float]]:
+    """
+    Picks the tracks of every playlist in a single pass over the library.
+    Each track is only checked against the playlists that could select it: those listing one of its artists or its title,
+    and those with titles: or artist names: constraints, which have to look at every track.
+    runs: commands are executed afterwards, through runner, on the tracks that passed every other check.
+    Returns the tracks picked for each playlist and the time spent matching for each playlist, in the order of playlists.
+    """
+    compiled = [playlist.compiled or CompiledPlaylistSpec(playlist) for playlist in playlists]
+    by_artist: dict[str, list[int]] = defaultdict(list)
+    by_title: dict[str, list[int]] = defaultdict(list)
+    everywhere: list[int] = []
+    for i, spec in enumerate(compiled):
+        for artist in spec.artists:
+            by_artist[artist].append(i)
+        for title in spec.tracks_artists:
+            by_title[title].append(i)
+        if spec.titles or spec.artist_names:
+            everywhere.append(i)
+
+    picked: list[list[Track]] = [[] for _ in playlists]
+    durations = [0.0] * len(playlists)
+    for track in library:
+        candidates = set(everywhere)
+        for artist in track.artists:
+            candidates.update(by_artist.get(artist, ()))
+        candidates.update(by_title.get(track.title, ()))
+        for i in candidates:
+            start = perf_counter()
+            if compiled[i].matches(track, runs=False):
+                picked[i].append(track)
+            durations[i] += perf_counter() - start
+
+    runner = runner or PredicateRunner()
+    for i, spec in enumerate(compiled):
+        start = perf_counter()
+        picked[i] = spec.run_commands(picked[i], runner)
+        durations[i] += perf_counter() - start
+
+    return picked, durations
+
+
+def autofill(playlist: PlaylistSpec, tracks: list[Track], jobs: int = 16) -> tuple[list[Track], list[str]]:
+    """
+    Makes the playlist's directory contain exactly a symlink for each track, and writes its playlist.m3u.
+    The directory is listed once and compared with what it should contain. Symlinks are created and removed in a thread pool,
+    which hides the latency of each call on network filesystems.
+    Only symlinks pointing to a file of the library are ever removed.
+    The m3u is written once every new symlink exists and before stale ones are removed, through a temporary file,
+    so that players never see a half-written playlist or one that refers to missing files.
+    Returns the tracks that were linked and the file names that were unlinked.
+    """
+    desired = {track.filepath.name: track for track in tracks}
+    symlinks: set[str] = set()
+    present: set[str] = set()
+    with os.scandir(playlist.directory) as entries:
+        for entry in entries:
+            present.add(entry.name)
+            if entry.is_symlink():
+                symlinks.add(entry.name)
+
+    to_create = [track for name, track in desired.items() if name not in present]
+    to_remove = [
+        name
+        for name in symlinks - desired.keys()
+        if name.endswith(".mp3") and Path(os.readlink(playlist.directory / name)).parent == here
+    ]
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        list(pool.map(lambda track: (playlist.directory / track.filepath.name).symlink_to(track.filepath), to_create))
+        for track in to_create:
+            print(f"  [bold]+ [/][green]{track}")
+
+        temporary = playlist.directory / ".playlist.m3u.tmp"
+        temporary.write_text(playlist.m3u(tracks))
+        temporary.replace(playlist.directory / "playlist.m3u")
+
+        list(pool.map(lambda name: (playlist.directory / name).unlink(), to_remove))
+        for name in to_remove:
+            print(f"  [bold]- [/][red]{name}")
+
+    return to_create, to_remove
+
+
+class PlaylistManifest:
     """
-    Yields tuples of type (Track, Path), where the first is the track picked and the second is the path the track's file was symlinked to
+    What each playlist looked like after the last run: a hash of its spec, the catalog version it was picked from and the file names picked.
+    Playlists whose spec and library didn't change since are skipped entirely.
     """
-    for track in tracks:
-        if (created := not (playlist.directory / track.filepath.name).exists()) :
-            (playlist.directory / track.filepath.name).symlink_to(track.filepath)
-        print(f"  [{'bold' if created else 'dim'}]- [/][green]{track}")
 
+    path: Path
+    playlists: dict[str, dict]
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.playlists = json.loads(path.read_text("utf8")) if path.exists() else {}
+
+    @staticmethod
+    def key(spec: Path) -> str:
+        return str(spec.parent.relative_to(here))
+
+    @staticmethod
+    def spec_hash(spec: Path) -> str:
+        """
+        from: playlists also depend on the tracklist.tsv backup.py keeps next to autofill.yaml
+        """
+        digest = sha256(spec.read_bytes())
+        if (tracklist := spec.parent / "tracklist.tsv").exists():
+            digest.update(tracklist.read_bytes())
+        return digest.hexdigest()
+
+    def unchanged(self, spec: Path, catalog_version: int) -> bool:
+        previous = self.playlists.get(self.key(spec), {})
+        return previous.get("spec") == self.spec_hash(spec) and previous.get("catalog") == catalog_version
+
+    def previous_tracks(self, spec: Path) -> list[str]:
+        return self.playlists.get(self.key(spec), {}).get("tracks", [])
+
+    def update(self, spec: Path, catalog_version: int, tracks: list[Track]):
+        self.playlists[self.key(spec)] = {
+            "spec": self.spec_hash(spec),
+            "catalog": catalog_version,
+            "tracks": [track.filepath.name for track in tracks],
+        }
 
-def all_tracks() -> Iterable[Track]:
-    for track in here.iterdir():
-        if track.suffix != ".mp3":
-            continue
-        if len(track.name.split("  ")) != 3:
-            continue
-        yield Track(filepath=track)
+    def save(self):
+        temporary = self.path.with_suffix(".tmp")
+        temporary.write_text(json.dumps(self.playlists, ensure_ascii=False, indent=2), encoding="utf8")
+        temporary.replace(self.path)
 
 
 if __name__ == "__main__":
 
-    def do(dir: Path):
+    with Catalog.open(here) as catalog:
+        index = LibraryIndex(catalog.tracks())
+        version = catalog.version
+    manifest = PlaylistManifest(cache_directory(here) / "fill-manifest.json")
+
+    def specs_in(dir: Path) -> Iterable[Path]:
         for file in dir.iterdir():
             if not file.is_dir():
                 continue
             if not (file / "autofill.yaml").exists():
-                do(file)
+                yield from specs_in(file)
                 continue
-
-            print(f"[blue]{file.name}[/][yellow]:")
-            playlist = PlaylistSpec.from_yaml(file / "autofill.yaml")
-            tracks = list(playlist.pick_from(all_tracks()))
-            (playlist.directory / "playlist.m3u").write_text(playlist.m3u(tracks))
+            yield file / "autofill.yaml"
+
+    specs = list(specs_in(here))
+    changed = [spec for spec in specs if not manifest.unchanged(spec, version)]
+    print(f"{len(specs) - len(changed)} playlists unchanged since the last run")
+    playlists = [PlaylistSpec.from_yaml(spec, index) for spec in changed]
+
+    start = perf_counter()
+    runner = PredicateRunner(cache_directory(here) / "runs-cache.json")
+    picked, durations = pick_all(playlists, index, runner)
+    runner.save()
+    print(f"Matched {len(index)} tracks against {len(playlists)} playlists in {perf_counter() - start:.3f}s")
+
+    for spec, playlist, tracks, duration in zip(changed, playlists, picked, durations):
+        print(f"[blue]{playlist.directory.name}[/][yellow]:[/] [dim]{len(tracks)} tracks, matched in {duration * 1000:.1f}ms")
+        if [track.filepath.name for track in tracks] != manifest.previous_tracks(spec):
             autofill(playlist, tracks)
-
-    do(here)
+        manifest.update(spec, version, tracks)
+        manifest.save()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+"""
+The downloaded library: mp3 files named "{artists}  {title}  {youtube id}.mp3".
+"""
+
+from collections import defaultdict
+from pathlib import Path
+from typing import Iterable, NamedTuple, Optional
+import os
+import sqlite3
+import time
+
+here = Path(__file__).parent
+
+
+class Track:
+    title: str
+    artists: set[str]
+    youtube_source_video_id: str
+    filepath: Path
+
+    def __init__(
+        self,
+        filepath: Path,
+        title: str = "",
+        artists: set[str] = set(),
+        youtube_source_video_id: Optional[str] = None,
+    ) -> None:
+        self.filepath = filepath
+        artists_str, title_str, video_id = self.filepath.name.split("  ", 2)
+        self.title = title or title_str.replace("∕", "/")
+        self.artists = set(artists or artists_str.split(", "))
+        self.youtube_source_video_id = youtube_source_video_id or video_id.removesuffix(
+            self.filepath.suffix
+        )
+
+    @property
+    def remixed(self) -> bool:
+        return len(self.artists) >= 2 and "remix" in map(str.lower, list(self.title))
+
+    def __str__(self) -> str:
+        return f"{', '.join(self.artists)} — {self.title}"
+
+    __repr__ = __str__
+
+
+def cache_directory(directory: Path = here) -> Path:
+    """
+    Where scripts keep their state between runs (manifests, caches, journals).
+    Creating or renaming files next to the mp3 files would change the directory's mtime, and make Catalog.refresh rescan everything.
+    """
+    cache = directory / ".cache"
+    cache.mkdir(exist_ok=True)
+    return cache
+
+
+def normalize_title(title: str) -> str:
+    """
+    Titles are stored in file names with slashes replaced by "∕" (or "⁄" when they come from library.tsv)
+    """
+    return title.replace("∕", "/").replace("⁄", "/").strip().casefold()
+
+
+def tag_track(title: str, artists: set[str], file: Path) -> bool:
+    """
+    Writes the title and artists as written in library.tsv, slashes included.
+    Returns True if the tag was applied, False if it was already applied
+    """
+    from mutagen.easyid3 import EasyID3
+    from mutagen.id3 import ID3NoHeaderError
+
+    try:
+        track = EasyID3(str(file))
+    except ID3NoHeaderError:
+        track = EasyID3()
+    if set(track.get("artist", [])) == set(artists) and track.get("title", [""])[0] == title:
+        return False
+    track["title"] = title
+    track["artist"] = "\0".join(artists)
+    track.save(str(file))
+    print(f"Tagged {file.name!r} as {', '.join(artists)} — {title}")
+    return True
+
+
+def scan(directory: Path = here) -> Iterable[Track]:
+    """
+    Walks the whole directory. Prefer all_tracks, which only looks at what changed since the last run.
+    """
+    for track in directory.iterdir():
+        if track.suffix != ".mp3":
+            continue
+        if len(track.name.split("  ")) != 3:
+            continue
+        yield Track(filepath=track)
+
+
+def all_tracks(directory: Path = here) -> Iterable[Track]:
+    with Catalog.open(directory) as catalog:
+        return catalog.tracks()
+
+
+def find_file_of_track(library: Iterable[Path], artists: set[str], title: str) -> Path:
+    """
+    Linear scan over the library. Prefer LibraryIndex.find when resolving more than a handful of tracks.
+    """
+    for track in library:
+        t_artists_str, t_title, *_ = track.name.split("  ")
+        t_title = t_title.replace('∕', '/')
+        t_artists = set(t_artists_str.split(', '))
+        if title.strip() == t_title.strip():
+            return track
+    raise KeyError(
+        f"No file found in given library ({[f.name for f in library]}) for track {artists}\t{title}"
+    )
+
+
+class LibraryIndex:
+    """
+    Lookup tables over the library, built once per run.
+    """
+
+    tracks: list[Track]
+    by_title: dict[str, list[Track]]
+    by_artists: dict[frozenset[str], list[Track]]
+    by_youtube_id: dict[str, Track]
+
+    def __init__(self, tracks: Iterable[Track]) -> None:
+        self.tracks = list(tracks)
+        self.by_title = defaultdict(list)
+        self.by_artists = defaultdict(list)
+        self.by_youtube_id = {}
+        for track in self.tracks:
+            self.by_title[normalize_title(track.title)].append(track)
+            self.by_artists[frozenset(track.artists)].append(track)
+            self.by_youtube_id[track.youtube_source_video_id] = track
+
+    @classmethod
+    def of_directory(cls, directory: Path = here) -> "LibraryIndex":
+        return cls(all_tracks(directory))
+
+    def __len__(self) -> int:
+        return len(self.tracks)
+
+    def __iter__(self):
+        return iter(self.tracks)
+
+    def find(self, artists: set[str], title: str) -> Track:
+        """
+        Returns the track with that title that shares an artist with artists.
+        Raises KeyError if there's none: many titles (e.g. "Voices") are shared by tracks of different artists.
+        """
+        wanted = {normalize_title(a) for a in artists}
+        for track in self.by_title.get(normalize_title(title), []):
+            if wanted & {normalize_title(a) for a in track.artists}:
+                return track
+        raise KeyError(f"No file found in library for track {artists}\t{title}")
+
+    def by_artist_set(self, artists: set[str]) -> list[Track]:
+        return self.by_artists.get(frozenset(artists), [])
+
+    def by_video(self, youtube_id: str) -> Track:
+        return self.by_youtube_id[youtube_id]
+
+
+class CatalogEntry(NamedTuple):
+    filename: str
+    artists: str  # as written in the file name, e.g. "Artist 1, Artist 2"
+    title: str  # as written in the file name, i.e. with "/" replaced
+    youtube_id: str
+    size: int
+    mtime_ns: int
+
+    def track(self, directory: Path) -> Track:
+        return Track(
+            filepath=directory / self.filename,
+            title=self.title.replace("∕", "/"),
+            artists=set(self.artists.split(", ")),
+            youtube_source_video_id=self.youtube_id,
+        )
+
+
+class Catalog:
+    """
+    Parsed file names of the library, stored in an SQLite database in the library's .cache/.
+    refresh() only re-reads the directory when its mtime changed, and only re-parses files that are new or changed.
+    """
+
+    # Some file systems (e.g. network mounts) only have timestamps to the second or two:
+    # a file added right after the directory was read might not change its mtime.
+    MTIME_RESOLUTION_NS = 2_000_000_000
+
+    directory: Path
+    db: sqlite3.Connection
+
+    def __init__(self, directory: Path = here, path: Optional[Path] = None) -> None:
+        self.directory = directory
+        self.db = sqlite3.connect(path or cache_directory(directory) / "catalog.sqlite3")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS tracks (
+                filename TEXT PRIMARY KEY,
+                artists TEXT NOT NULL,
+                title TEXT NOT NULL,
+                youtube_id TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            """
+        )
+
+    @classmethod
+    def open(cls, directory: Path = here) -> "Catalog":
+        catalog = cls(directory)
+        catalog.refresh()
+        return catalog
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self) -> "Catalog":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def _meta(self, key: str, default: int = 0) -> int:
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key: str, value: int):
+        self.db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+        )
+
+    @property
+    def version(self) -> int:
+        """
+        Incremented every time a refresh finds added, removed or changed files
+        """
+        return self._meta("version")
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Returns True if the catalog changed
+        """
+        read_at = time.time_ns()
+        directory_mtime = self.directory.stat().st_mtime_ns
+        if (
+            not force
+            and directory_mtime == self._meta("directory_mtime_ns", -1)
+            and self._meta("directory_read_at_ns") - directory_mtime > self.MTIME_RESOLUTION_NS
+        ):
+            return False
+
+        known = {
+            filename: (size, mtime_ns)
+            for filename, size, mtime_ns in self.db.execute(
+                "SELECT filename, size, mtime_ns FROM tracks"
+            )
+        }
+        changed: list[CatalogEntry] = []
+        seen = set()
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".mp3"):
+                    continue
+                if len(parts := entry.name.split("  ")) != 3:
+                    continue
+                seen.add(entry.name)
+                stat = entry.stat()
+                if known.get(entry.name) == (stat.st_size, stat.st_mtime_ns):
+                    continue
+                artists, title, video_id = parts
+                changed.append(
+                    CatalogEntry(
+                        filename=entry.name,
+                        artists=artists,
+                        title=title,
+                        youtube_id=video_id.removesuffix(".mp3"),
+                        size=stat.st_size,
+                        mtime_ns=stat.st_mtime_ns,
+                    )
+                )
+        removed = known.keys() - seen
+
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?)", changed
+            )
+            self.db.executemany(
+                "DELETE FROM tracks WHERE filename = ?", ((f,) for f in removed)
+            )
+            if changed or removed:
+                self._set_meta("version", self.version + 1)
+            self._set_meta("directory_mtime_ns", directory_mtime)
+            self._set_meta("directory_read_at_ns", read_at)
+
+        return bool(changed or removed)
+
+    def entries(self) -> list[CatalogEntry]:
+        return [
+            CatalogEntry(*row)
+            for row in self.db.execute(
+                "SELECT filename, artists, title, youtube_id, size, mtime_ns FROM tracks ORDER BY filename"
+            )
+        ]
+
+    def tracks(self) -> list[Track]:
+        return [entry.track(self.directory) for entry in self.entries()]
@@ -0,0 +1,169 @@
+# /// script
+# requires-python = ">=3.12"
+# dependencies = [
+#     "rich",
+#     "docopt",
+#     "matplotlib",
+# ]
+# ///
+
+"""
+Usage:
+    library_stats.py [--top=<n>] [--plot] [--min-count=<n>] [--directory=<path>]
+
+Statistics on library.tsv and the tracklist.tsv of every playlist, aggregated once and shown in the terminal, and with --plot in matplotlib.
+
+Options:
+    --top=<n>             Number of rows of each table [default: 20]
+    --plot                Also plot artists and playlists with matplotlib
+    --min-count=<n>       Only plot artists credited on at least that many liked tracks [default: 10]
+    --directory=<path>    Where library.tsv and the playlists are [default: .]
+"""
+
+#!/usr/bin/env python
+from collections import Counter
+from itertools import combinations
+from pathlib import Path
+from typing import NamedTuple
+from docopt import docopt
+from rich import print
+from rich.console import Console
+from rich.table import Table
+from update_artist_counts import read_counts
+
+here = Path(__file__).parent
+
+
+def read_columns(tsv: Path) -> tuple[list[str], list[str]]:
+    """
+    The artists and titles columns of a "Artist\tTitle\t..." file
+    """
+    artists, titles = [], []
+    for line in tsv.read_text("utf8").splitlines()[1:]:
+        if "\t" not in line or line.startswith("# vim"):
+            continue
+        artist, title, *_ = line.split("\t")
+        artists.append(artist)
+        titles.append(title)
+    return artists, titles
+
+
+def credits(artists_column: list[str]) -> list[list[str]]:
+    return [artists.split(", ") for artists in artists_column]
+
+
+class LibraryStats(NamedTuple):
+    artists: Counter  # artist -> number of liked tracks they're credited on
+    collaborations: Counter  # (artist, artist) in alphabetical order -> number of liked tracks they're both credited on
+    playlists: dict[str, Counter]  # playlist -> artist -> number of tracks in the playlist they're credited on
+    playlist_sizes: dict[str, int]
+    artist_playlists: Counter  # artist -> number of playlists they're in
+    tracks: int
+    counts_up_to_date: bool  # whether counts.tsv agrees with library.tsv
+
+    @classmethod
+    def of_directory(cls, directory: Path = here) -> "LibraryStats":
+        artists_column, _ = read_columns(directory / "library.tsv")
+        library_credits = credits(artists_column)
+
+        artists = Counter(artist for track in library_credits for artist in track)
+        collaborations = Counter(
+            pair
+            for track in library_credits
+            if len(track) > 1
+            for pair in combinations(sorted(set(track)), 2)
+        )
+
+        playlists = {}
+        playlist_sizes = {}
+        for tracklist in sorted(directory.glob("*/**/tracklist.tsv")):
+            name = str(tracklist.parent.relative_to(directory))
+            playlist_artists, _ = read_columns(tracklist)
+            playlists[name] = Counter(
+                artist for track in credits(playlist_artists) for artist in track
+            )
+            playlist_sizes[name] = len(playlist_artists)
+
+        counts_file = directory / "counts.tsv"
+        return cls(
+            artists=artists,
+            collaborations=collaborations,
+            playlists=playlists,
+            playlist_sizes=playlist_sizes,
+            artist_playlists=Counter(artist for artists in playlists.values() for artist in artists),
+            tracks=len(artists_column),
+            counts_up_to_date=counts_file.exists() and read_counts(counts_file) == artists,
+        )
+
+
+def ranking_table(title: str, rows: list[tuple[str, int]], column: str, count_column: str = "Tracks") -> Table:
+    table = Table(title=title, title_justify="left", box=None)
+    table.add_column(column)
+    table.add_column(count_column, justify="right", style="bold")
+    for name, count in rows:
+        table.add_row(name, str(count))
+    return table
+
+
+def print_report(stats: LibraryStats, top: int = 20):
+    console = Console()
+    print(
+        f"[bold]{stats.tracks}[/] liked tracks by [bold]{len(stats.artists)}[/] artists, "
+        f"[bold]{len(stats.playlists)}[/] playlists"
+    )
+    if not stats.counts_up_to_date:
+        print("[yellow]counts.tsv is out of date, run update_artist_counts.py")
+
+    console.print(ranking_table("Most liked artists", stats.artists.most_common(top), "Artist"))
+    console.print(
+        ranking_table(
+            "Largest playlists",
+            Counter(stats.playlist_sizes).most_common(top),
+            "Playlist",
+        )
+    )
+    console.print(
+        ranking_table(
+            "Most frequent collaborations",
+            [(" × ".join(pair), count) for pair, count in stats.collaborations.most_common(top)],
+            "Artists",
+        )
+    )
+    console.print(
+        ranking_table(
+            "Artists in the most playlists",
+            stats.artist_playlists.most_common(top),
+            "Artist",
+            count_column="Playlists",
+        )
+    )
+
+
+def plot_artists(stats: LibraryStats, min_count: int = 10, axes=None):
+    import matplotlib.pyplot as plt
+
+    ranking = sorted(
+        ((artist, count) for artist, count in stats.artists.items() if count >= min_count),
+        key=lambda item: item[1],
+    )
+    (axes or plt.gca()).barh([artist for artist, _ in ranking], [count for _, count in ranking])
+
+
+def plot_playlists(stats: LibraryStats, axes=None):
+    import matplotlib.pyplot as plt
+
+    ranking = sorted(stats.playlist_sizes.items(), key=lambda item: item[1])
+    (axes or plt.gca()).barh([name for name, _ in ranking], [size for _, size in ranking])
+
+
+if __name__ == "__main__":
+    args = docopt(__doc__)
+    stats = LibraryStats.of_directory(Path(args["--directory"]))
+    print_report(stats, top=int(args["--top"]))
+    if args["--plot"]:
+        import matplotlib.pyplot as plt
+
+        _, (artists_axes, playlists_axes) = plt.subplots(1, 2)
+        plot_artists(stats, int(args["--min-count"]), artists_axes)
+        plot_playlists(stats, playlists_axes)
+        plt.show()
@@ -1,13 +1,17 @@
 #!/usr/bin/env python3
 
 import argparse 
-import codecs
+import collections
+import concurrent.futures
 import http.client
 import http.server
 import json
 import logging
+import os
+import random
 import re
 import sys
+import threading
 import time
 import urllib.error
 import urllib.parse
@@ -16,54 +20,126 @@ import webbrowser
 
 logging.basicConfig(level=20, datefmt='%I:%M:%S', format='[%(asctime)s] %(message)s')
 
+# Where requests are sent, can be pointed at fake_spotify_api.py.
+API_URL = os.environ.get('SPOTIFY_API_URL', 'https://api.spotify.com/v1/')
+
 
 class SpotifyAPI:
 	
-	# Requires an OAuth token.
-	def __init__(self, auth):
+	# Requires an OAuth token. Pages of lists are loaded by up to `jobs` threads at once.
+	def __init__(self, auth, jobs=8, api_url=API_URL):
 		self._auth = auth
+		self._api_url = api_url
+		self._local = threading.local()
+		self._pages = concurrent.futures.ThreadPoolExecutor(jobs)
+		self._rate_limit_lock = threading.Lock()
+		self._resume_at = 0
+	
+	# Each thread keeps its own connection open between requests, instead of connecting again for every page.
+	def _connection(self):
+		if getattr(self._local, 'connection', None) is None:
+			api = urllib.parse.urlsplit(self._api_url)
+			connection_class = http.client.HTTPSConnection if api.scheme == 'https' else http.client.HTTPConnection
+			self._local.connection = connection_class(api.netloc, timeout=30)
+		return self._local.connection
+	
+	# The connection might be in a broken state after an error, start a new one next time.
+	def _reset_connection(self):
+		if getattr(self._local, 'connection', None) is not None:
+			self._local.connection.close()
+			self._local.connection = None
+	
+	# Exponential backoff with jitter, so that threads that failed together don't all retry at the same time.
+	@staticmethod
+	def _backoff(attempt):
+		return min(60, 2 ** attempt) * random.uniform(0.5, 1)
 	
 	# Gets a resource from the Spotify API and returns the object.
-	def get(self, url, params={}, tries=3):
+	# Waits for as long as Spotify says when rate limited, and retries server and network errors with backoff.
+	# Raises SpotifyAPI.Error on other errors (e.g. an expired token), or after `tries` attempts.
+	def get(self, url, params={}, tries=6):
 		# Construct the correct URL.
-		if not url.startswith('https://api.spotify.com/v1/'):
-			url = 'https://api.spotify.com/v1/' + url
+		if not url.startswith(self._api_url):
+			url = self._api_url + url
 		if params:
 			url += ('&' if '?' in url else '?') + urllib.parse.urlencode(params)
+		path = urllib.parse.urlsplit(url)._replace(scheme='', netloc='').geturl()
 	
-		# Try the sending off the request a specified number of times before giving up.
-		for _ in range(tries):
+		for attempt in range(tries):
+			# Rate limits apply to the whole app, so every thread waits when one of them gets limited.
+			if (wait := self._resume_at - time.monotonic()) > 0:
+				time.sleep(wait)
+
 			try:
-				req = urllib.request.Request(url)
-				req.add_header('Authorization', 'Bearer ' + self._auth)
-				res = urllib.request.urlopen(req)
-				reader = codecs.getreader('utf-8')
-				return json.load(reader(res))
-			except Exception as err:
-				logging.info('Couldn\'t load URL: {} ({})'.format(url, err))
-				time.sleep(2)
-				logging.info('Trying again...')
-		sys.exit(1)
+				connection = self._connection()
+				connection.request('GET', path, headers={'Authorization': 'Bearer ' + self._auth})
+				res = connection.getresponse()
+				body = res.read()
+			except (OSError, http.client.HTTPException) as err:
+				self._reset_connection()
+				delay = self._backoff(attempt)
+				logging.info(f'Couldn\'t load URL: {url} ({err}), trying again in {delay:.1f}s')
+				time.sleep(delay)
+				continue
+
+			if res.status == 429:
+				retry_after = int(res.headers.get('Retry-After', 1))
+				with self._rate_limit_lock:
+					if time.monotonic() + retry_after > self._resume_at:
+						logging.info(f'Rate limited, waiting {retry_after}s')
+						self._resume_at = time.monotonic() + retry_after
+				continue
+			if res.status >= 500:
+				delay = self._backoff(attempt)
+				logging.info(f'Couldn\'t load URL: {url} ({res.status} {res.reason}), trying again in {delay:.1f}s')
+				time.sleep(delay)
+				continue
+			if res.status >= 400:
+				raise SpotifyAPI.Error(f'Couldn\'t load URL: {url} ({res.status} {res.reason}: {body.decode("utf-8", "replace")})')
+			return json.loads(body.decode('utf-8'))
+
+		raise SpotifyAPI.Error(f'Couldn\'t load URL: {url}, gave up after {tries} tries')
 	
 	# The Spotify API breaks long lists into multiple pages. This method automatically
 	# fetches all pages and joins them, returning in a single list of objects.
+	# The first page gives the total number of items, the remaining pages are then loaded concurrently.
 	def list(self, url, params={}):
-		last_log_time = time.time()
 		response = self.get(url, params)
-		items = response['items']
+		limit = response['limit'] or len(response['items']) or 1
+		offsets = range(response['offset'] + limit, response['total'], limit)
+		pages = self._pages.map(lambda offset: self.get(url, {**params, 'limit': limit, 'offset': offset}), offsets)
 
-		while response['next']:
+		items = response['items']
+		last_log_time = time.time()
+		for page in pages:
 			if time.time() > last_log_time + 15:
 				last_log_time = time.time()
 				logging.info(f"Loaded {len(items)}/{response['total']} items")
-
-			response = self.get(response['next'])
-			items += response['items']
+			items += page['items']
 		return items
 	
+	# Loads the tracks of playlists, several at once, yielding each playlist in order as soon as it's loaded.
+	# At most `window` playlists are held in memory, waiting to be written out.
+	# Playlists already in the checkpoint, with the same snapshot_id, are read from it instead.
+	def playlists_with_tracks(self, playlists, checkpoint, window=8):
+		def load(playlist):
+			def load_tracks():
+				logging.info('Loading playlist: {name} ({tracks[total]} songs)'.format(**playlist))
+				return self.list(playlist['tracks']['href'], {'limit': 100})
+			return {**playlist, 'tracks': checkpoint.load(playlist['id'], playlist['snapshot_id'], load_tracks)}
+
+		with concurrent.futures.ThreadPoolExecutor(window) as loaders:
+			pending = collections.deque()
+			for playlist in playlists:
+				pending.append(loaders.submit(load, playlist))
+				if len(pending) >= window:
+					yield pending.popleft().result()
+			while pending:
+				yield pending.popleft().result()
+	
 	# Pops open a browser window for a user to log in and authorize API access.
 	@staticmethod
-	def authorize(client_id, scope):
+	def authorize(client_id, scope, **options):
 		url = 'https://accounts.spotify.com/authorize?' + urllib.parse.urlencode({
 			'response_type': 'token',
 			'client_id': client_id,
@@ -79,7 +155,7 @@ class SpotifyAPI:
 			while True:
 				server.handle_request()
 		except SpotifyAPI._Authorization as auth:
-			return SpotifyAPI(auth.access_token)
+			return SpotifyAPI(auth.access_token, **options)
 	
 	# The port that the local server listens on. Don't change this,
 	# as Spotify only will redirect to certain predefined URLs.
@@ -124,6 +200,54 @@ class SpotifyAPI:
 	class _Authorization(Exception):
 		def __init__(self, access_token):
 			self.access_token = access_token
+	
+	class Error(Exception):
+		pass
+
+
+class Checkpoint:
+
+	# Lists loaded so far are appended to a JSON lines file, so that running again after a failure doesn't load them again.
+	def __init__(self, path):
+		self._path = path
+		self._lock = threading.Lock()
+		self._offsets = {}
+		if not os.path.exists(path):
+			return
+
+		with open(path, 'r+b') as f:
+			offset = 0
+			for line in f:
+				# The last line might have been cut short.
+				try:
+					entry = json.loads(line)
+				except ValueError:
+					break
+				self._offsets[(entry['key'], entry['version'])] = offset
+				offset += len(line)
+			f.truncate(offset)
+		logging.info(f'Resuming from {path}: {len(self._offsets)} lists already loaded')
+
+	# Returns the list stored under (key, version), or calls loader and stores what it returns.
+	def load(self, key, version, loader):
+		if (key, version) in self._offsets:
+			with open(self._path, 'rb') as f:
+				f.seek(self._offsets[(key, version)])
+				return json.loads(f.readline())['value']
+
+		value = loader()
+		line = (json.dumps({'key': key, 'version': version, 'value': value}) + '\n').encode('utf-8')
+		with self._lock:
+			with open(self._path, 'ab') as f:
+				offset = f.tell()
+				f.write(line)
+			self._offsets[(key, version)] = offset
+		return value
+
+	# Once the export is complete.
+	def remove(self):
+		if os.path.exists(self._path):
+			os.remove(self._path)
 
 
 def main():
@@ -136,6 +260,7 @@ def main():
 	parser.add_argument('--dump', default='playlists', choices=['liked,playlists', 'playlists,liked', 'playlists', 'liked'],
 	                    help='dump playlists or liked songs, or both (default: playlists)')
 	parser.add_argument('--format', default='txt', choices=['json', 'txt'], help='output format (default: txt)')
+	parser.add_argument('--api-url', default=API_URL, help='base URL of the Spotify Web API (default: {})'.format(API_URL.replace('%', '%%')))
 	parser.add_argument('file', help='output filename', nargs='?')
 	args = parser.parse_args()
 	
@@ -146,52 +271,34 @@ def main():
 	
 	# Log into the Spotify API.
 	if args.token:
-		spotify = SpotifyAPI(args.token)
+		spotify = SpotifyAPI(args.token, api_url=args.api_url)
 	else:
 		spotify = SpotifyAPI.authorize(client_id='5c098bcc800e45d49e476265bc9b6934',
-		                               scope='playlist-read-private playlist-read-collaborative user-library-read')
+		                               scope='playlist-read-private playlist-read-collaborative user-library-read',
+		                               api_url=args.api_url)
 	
 	# Get the ID of the logged in user.
 	logging.info('Loading user info...')
 	me = spotify.get('me')
 	logging.info('Logged in as {display_name} ({id})'.format(**me))
 
-	playlists = []
-	liked_albums = []
-
-	# List liked albums and songs
-	if 'liked' in args.dump:
-		logging.info('Loading liked albums and songs...')
-		liked_tracks = spotify.list('me/tracks', {'limit': 50})
-		liked_albums = spotify.list('me/albums', {'limit': 50})
-		playlists += [{'name': 'Liked Songs', 'tracks': liked_tracks}]
-
-	# List all playlists and the tracks in each playlist
-	if 'playlists' in args.dump:
-		logging.info('Loading playlists...')
-		playlist_data = spotify.list('users/{user_id}/playlists'.format(user_id=me['id']), {'limit': 50})
-		logging.info(f'Found {len(playlist_data)} playlists')
-
-		# List all tracks in each playlist
-		for playlist in playlist_data:
-			logging.info('Loading playlist: {name} ({tracks[total]} songs)'.format(**playlist))
-			playlist['tracks'] = spotify.list(playlist['tracks']['href'], {'limit': 100})
-		playlists += playlist_data
-	
-	# Write the file.
-	logging.info('Writing files...')
+	# Playlists are written out as they are loaded, so that only a handful are in memory at any time.
+	checkpoint = Checkpoint(args.file + '.checkpoint')
 	with open(args.file, 'w', encoding='utf-8') as f:
-		# JSON file.
 		if args.format == 'json':
-			json.dump({
-				'playlists': playlists,
-				'albums': liked_albums
-			}, f)
-		
-		# Tab-separated file.
+			f.write('{"playlists": [')
 		else:
 			f.write('Playlists: \r\n\r\n')
-			for playlist in playlists:
+		written = 0
+
+		def write_playlist(playlist):
+			nonlocal written
+			# JSON file.
+			if args.format == 'json':
+				f.write((', ' if written else '') + json.dumps(playlist))
+			
+			# Tab-separated file.
+			else:
 				f.write(playlist['name'] + '\r\n')
 				for track in playlist['tracks']:
 					if track['track'] is None:
@@ -204,18 +311,47 @@ def main():
 						release_date=track['track']['album']['release_date']
 					))
 				f.write('\r\n')
-			if len(liked_albums) > 0:
-				f.write('Liked Albums: \r\n\r\n')
-				for album in liked_albums:
-					uri = album['album']['uri']
-					name = album['album']['name']
-					artists = ', '.join([artist['name'] for artist in album['album']['artists']])
-					release_date = album['album']['release_date']
-					album = f'{artists} - {name}'
+			written += 1
+
+		# List liked songs
+		if 'liked' in args.dump:
+			logging.info('Loading liked songs...')
+			write_playlist({'name': 'Liked Songs', 'tracks': checkpoint.load('me/tracks', None, lambda: spotify.list('me/tracks', {'limit': 50}))})
+
+		# List all playlists and the tracks in each playlist
+		if 'playlists' in args.dump:
+			logging.info('Loading playlists...')
+			playlist_data = spotify.list('users/{user_id}/playlists'.format(user_id=me['id']), {'limit': 50})
+			logging.info(f'Found {len(playlist_data)} playlists')
+
+			for playlist in spotify.playlists_with_tracks(playlist_data, checkpoint):
+				write_playlist(playlist)
 
-					f.write(f'{name}\t{artists}\t-\t{uri}\t{release_date}\r\n')
+		# List liked albums
+		liked_albums = []
+		if 'liked' in args.dump:
+			logging.info('Loading liked albums...')
+			liked_albums = checkpoint.load('me/albums', None, lambda: spotify.list('me/albums', {'limit': 50}))
 
+		if args.format == 'json':
+			f.write('], "albums": ' + json.dumps(liked_albums) + '}')
+		elif len(liked_albums) > 0:
+			f.write('Liked Albums: \r\n\r\n')
+			for album in liked_albums:
+				uri = album['album']['uri']
+				name = album['album']['name']
+				artists = ', '.join([artist['name'] for artist in album['album']['artists']])
+				release_date = album['album']['release_date']
+				album = f'{artists} - {name}'
+
+				f.write(f'{name}\t{artists}\t-\t{uri}\t{release_date}\r\n')
+
+	checkpoint.remove()
 	logging.info('Wrote file: ' + args.file)
 
 if __name__ == '__main__':
-	main()
+	try:
+		main()
+	except SpotifyAPI.Error as err:
+		logging.error(f'{err}. Run again to resume where the export stopped.')
+		sys.exit(1)
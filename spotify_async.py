@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""
+Minimal asyncio Spotify Web API client, used by backup.py to fetch many playlists at once.
+
+All requests go through one pooled HTTP connection pool (kept alive between requests),
+at most `concurrency` of them in flight at any time.
+Set SPOTIFY_API_URL to point it somewhere else, e.g. at fake_spotify_api.py.
+"""
+
+import asyncio
+import os
+import random
+import httpx
+from rich import print
+
+API_URL = os.environ.get("SPOTIFY_API_URL", "https://api.spotify.com/v1/")
+
+
+def playlist_id(url: str) -> str:
+    """
+    https://open.spotify.com/playlist/<id>?si=... -> <id>
+    """
+    return url.split("/playlist/")[-1].split("?")[0]
+
+
+class AsyncSpotify:
+    requests_made: int = 0  # by all clients, rate-limited retries included
+    token: str
+    base_url: str
+    concurrency: int
+    max_retries: int
+
+    def __init__(
+        self,
+        token: str,
+        base_url: str = API_URL,
+        concurrency: int = 8,
+        max_retries: int = 5,
+    ) -> None:
+        self.token = token
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+
+    async def __aenter__(self) -> "AsyncSpotify":
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={"Authorization": f"Bearer {self.token}"},
+            limits=httpx.Limits(
+                max_connections=self.concurrency,
+                max_keepalive_connections=self.concurrency,
+            ),
+            timeout=30,
+        )
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._resume_at = 0.0
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self._client.aclose()
+
+    @staticmethod
+    def backoff(attempt: int) -> float:
+        """
+        Exponential backoff with jitter, so that requests that failed together don't all retry at the same time
+        """
+        return min(60, 2**attempt) * random.uniform(0.5, 1)
+
+    async def get(self, url: str, **params) -> dict:
+        """
+        Waits for as long as Spotify says to in Retry-After when rate-limited.
+        Every other request waits too, since the limit applies to the whole app.
+        Server errors (5xx) and network errors are retried with backoff.
+        Gives up after max_retries attempts, raising httpx.HTTPStatusError or httpx.TransportError. Other errors are raised right away.
+        """
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries):
+            last_attempt = attempt == self.max_retries - 1
+            async with self._slots:
+                if (wait := self._resume_at - loop.time()) > 0:
+                    await asyncio.sleep(wait)
+                AsyncSpotify.requests_made += 1
+                try:
+                    response = await self._client.get(url, params=params)
+                except httpx.TransportError as e:
+                    if last_attempt:
+                        raise
+                    response = e
+
+            if isinstance(response, httpx.TransportError):
+                delay = self.backoff(attempt)
+                print(f"[yellow]Couldn't reach Spotify ({response!r}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            if response.status_code == 429 and not last_attempt:
+                retry_after = int(response.headers.get("Retry-After", "1"))
+                if loop.time() + retry_after > self._resume_at:
+                    print(f"[yellow]Rate-limited by Spotify, waiting {retry_after}s")
+                    self._resume_at = loop.time() + retry_after
+                continue
+            if response.status_code >= 500 and not last_attempt:
+                delay = self.backoff(attempt)
+                print(f"[yellow]Spotify answered {response.status_code} for {url}, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            response.raise_for_status()
+            return response.json()
+
+    async def all_items(self, url: str, limit: int = 100, **params) -> list[dict]:
+        """
+        Gets every page of a paginated endpoint. The first page gives the total, the other ones are then fetched concurrently.
+        """
+        first = await self.get(url, limit=limit, offset=0, **params)
+        pages = await asyncio.gather(
+            *(
+                self.get(url, limit=limit, offset=offset, **params)
+                for offset in range(limit, first["total"], limit)
+            )
+        )
+        return [item for page in [first, *pages] for item in page["items"]]
+
+    async def playlist_items(self, url: str) -> list[dict]:
+        """
+        Only gets the fields backup.py needs: track names and artists
+        """
+        return await self.all_items(
+            f"playlists/{playlist_id(url)}/tracks",
+            fields="total,items(track(name,artists(name)))",
+        )
+
+    async def playlists_items(self, urls: list[str]) -> dict[str, list[dict]]:
+        """
+        Gets the tracks of every playlist, concurrently
+        """
+        results = await asyncio.gather(*(self.playlist_items(url) for url in urls))
+        return dict(zip(urls, results))
+
+    async def liked_tracks_since(self, added_at: str | None, limit: int = 50) -> list[dict]:
+        """
+        Liked tracks come newest first, so pages are read one after the other until one reaches added_at.
+        Tracks liked at exactly added_at are returned again, in case there were several liked that second.
+        Without added_at, every page is fetched (concurrently).
+        """
+        if not added_at:
+            return await self.all_items("me/tracks", limit=limit)
+
+        items = []
+        offset = 0
+        while True:
+            page = await self.get("me/tracks", limit=limit, offset=offset)
+            items += [item for item in page["items"] if item["added_at"] >= added_at]
+            if not page["next"] or any(item["added_at"] < added_at for item in page["items"]):
+                return items
+            offset += limit
+
+    async def snapshot_ids(self, urls: list[str]) -> dict[str, str]:
+        results = await asyncio.gather(
+            *(self.get(f"playlists/{playlist_id(url)}", fields="snapshot_id") for url in urls)
+        )
+        return {url: result["snapshot_id"] for url, result in zip(urls, results)}
+
+
+def fetch_playlists_items(token: str, urls: list[str], concurrency: int = 8) -> dict[str, list[dict]]:
+    async def fetch():
+        async with AsyncSpotify(token, concurrency=concurrency) as spotify:
+            return await spotify.playlists_items(urls)
+
+    return asyncio.run(fetch())
+
+
+def fetch_liked_tracks_since(token: str, added_at: str | None) -> list[dict]:
+    async def fetch():
+        async with AsyncSpotify(token) as spotify:
+            return await spotify.liked_tracks_since(added_at)
+
+    return asyncio.run(fetch())
+
+
+def fetch_snapshot_ids(token: str, urls: list[str], concurrency: int = 8) -> dict[str, str]:
+    async def fetch():
+        async with AsyncSpotify(token, concurrency=concurrency) as spotify:
+            return await spotify.snapshot_ids(urls)
+
+    return asyncio.run(fetch())
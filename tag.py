@@ -1,37 +1,108 @@
 #!/usr/bin/env python3
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from mutagen.easyid3 import EasyID3 
+from typing import NamedTuple
+import json
+import os
+from library import Catalog, cache_directory, tag_track
 
 here = Path(__file__).parent
 library_file = here / "library.tsv"
-library = [
-    t.replace("/", "⁄").split("  ", 2)
-    for t in library_file.read_text("UTF-8").splitlines()
-]
-
-def tag_track(title: str, artists: set[str], file: Path) -> bool:
-    """
-    Returns True if the tag was applied, False if it was already applied
-    """
-    track = EasyID3(str(file))
-    if set(track.get("artist", [])) == artists and track.get("title", [])[0] == title:
-        # print(f"Checked {track.get('artist', [])!r} against {artists!r}")
-        # print(f"Checked {track.get('title', [''])[0]!r} against {title!r}")
-        # print("⤷  Skipped")
-        return False
-    track["title"] = title
-    track["artist"] = "\0".join(artists)
-    track.save()
-    print(f"Tagged {file.name!r} as {', '.join(artists)} — {title}")
-    return True
 
-if __name__ == "__main__":
-    for artists_str, title in library:
-        artists = set(artists_str.split(", "))
-        for file in library_file.parent.iterdir():
-            if file.name.startswith(f"{artists_str}  {title}") and file.name.endswith(".mp3"):
-                tag_track(title, artists, file)
 
+def read_library() -> list[tuple[str, str]]:
+    """
+    (artists, title) rows of library.tsv
+    """
+    return [
+        tuple(line.split("\t")[:2])
+        for line in library_file.read_text("UTF-8").splitlines()[1:]
+        if "\t" in line and not line.startswith("# vim")
+    ]
+
+
+class TagJob(NamedTuple):
+    file: Path
+    artists: str  # as in library.tsv, e.g. "Artist 1, Artist 2"
+    title: str
+
+    @property
+    def tags(self) -> list:
+        return [self.artists, self.title]
+
+
+class TagCache:
+    """
+    The tags last written to or found in each file, with the file's size and mtime at that point.
+    Files that weren't modified since are not opened again.
+    """
+
+    path: Path
+    files: dict[str, list]  # file name -> [size, mtime_ns, artists, title]
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.files = json.loads(path.read_text("utf8")) if path.exists() else {}
+
+    @staticmethod
+    def stat(file: Path) -> list[int]:
+        stat = os.stat(file)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def up_to_date(self, job: TagJob) -> bool:
+        return self.files.get(job.file.name) == self.stat(job.file) + job.tags
 
+    def update(self, job: TagJob):
+        self.files[job.file.name] = self.stat(job.file) + job.tags
 
+    def save(self):
+        temporary = self.path.with_suffix(".tmp")
+        temporary.write_text(json.dumps(self.files, ensure_ascii=False), encoding="utf8")
+        temporary.replace(self.path)
 
+
+def tag_jobs(catalog: Catalog, rows: list[tuple[str, str]]) -> list[TagJob]:
+    """
+    Joins library rows to the files named after them, through the catalog.
+    Matching is case-sensitive, so that rows only differing in case don't fight over the same file.
+    """
+    files = defaultdict(list)
+    for entry in catalog.entries():
+        files[(entry.artists, entry.title.replace("∕", "⁄"))].append(catalog.directory / entry.filename)
+
+    jobs = {}
+    for artists, title in rows:
+        for file in files.get((artists.replace("/", "⁄"), title.replace("/", "⁄")), []):
+            jobs.setdefault(file, TagJob(file, artists, title))
+    return list(jobs.values())
+
+
+def tag_all(jobs: list[TagJob], cache: TagCache, workers: int = 16) -> tuple[int, int]:
+    """
+    Returns how many files were tagged and how many already were, not counting files skipped thanks to the cache
+    """
+    todo = [job for job in jobs if not cache.up_to_date(job)]
+
+    def run(job: TagJob) -> bool:
+        tagged = tag_track(job.title, set(job.artists.split(", ")), job.file)
+        cache.update(job)
+        return tagged
+
+    with ThreadPoolExecutor(workers) as pool:
+        tagged = sum(pool.map(run, todo))
+    return tagged, len(todo) - tagged
+
+
+if __name__ == "__main__":
+    cache = TagCache(cache_directory(here) / "tag-cache.json")
+    with Catalog.open(here) as catalog:
+        jobs = tag_jobs(catalog, read_library())
+    try:
+        tagged, already_tagged = tag_all(jobs, cache)
+    finally:
+        cache.save()
+    print(
+        f"Tagged {tagged} files, {already_tagged} already were, "
+        f"{len(jobs) - tagged - already_tagged} unchanged since last run"
+    )
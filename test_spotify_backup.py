@@ -0,0 +1,52 @@
+"""
+spotify-backup.py against fake_spotify_api.py. Run with pytest.
+"""
+
+from importlib.util import module_from_spec, spec_from_file_location
+from pathlib import Path
+import pytest
+from fake_spotify_api import serve_in_background
+
+spec = spec_from_file_location("spotify_backup", Path(__file__).parent / "spotify-backup.py")
+spotify_backup = module_from_spec(spec)
+spec.loader.exec_module(spotify_backup)
+
+
+@pytest.fixture
+def fake_api():
+    servers = []
+
+    def serve(**options):
+        server, url = serve_in_background(**options)
+        servers.append(server)
+        return server.RequestHandlerClass.fake, spotify_backup.SpotifyAPI("token", jobs=4, api_url=url)
+
+    yield serve
+    for server in servers:
+        server.shutdown()
+
+
+def test_list_returns_every_item_despite_throttling_and_failures(fake_api):
+    fake, api = fake_api(tracks_per_playlist=730, throttle_every=7, retry_after=0, fail_every=11)
+    items = api.list("playlists/somelist/tracks", {"limit": 100})
+    assert [item["track"]["name"] for item in items] == [f"Track {i} of somelist" for i in range(730)]
+    assert fake.requests > 8
+
+
+def test_client_errors_are_not_retried(fake_api):
+    fake, api = fake_api()
+    with pytest.raises(spotify_backup.SpotifyAPI.Error):
+        api.get("nope")
+    assert fake.requests == 1
+
+
+def test_checkpoint_resumes(tmp_path):
+    path = tmp_path / "checkpoint.jsonl"
+    spotify_backup.Checkpoint(path).load("playlist", "snapshot", lambda: ["a", "b"])
+
+    def loader():
+        raise AssertionError("loaded again")
+
+    resumed = spotify_backup.Checkpoint(path)
+    assert resumed.load("playlist", "snapshot", loader) == ["a", "b"]
+    assert resumed.load("playlist", "new snapshot", lambda: ["c"]) == ["c"]
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
+from collections import Counter
 from pathlib import Path
+from typing import Iterable, Optional
 import re
 from sys import argv
 
@@ -10,38 +12,77 @@ def natsort(s):
     return [int(t) if t.isdigit() else t.lower() for t in re.split(r"(\d+)", s.strip())]
 
 
-def update_artist_counts(silent=True):
-    print("counting artists")
-    # datasource = map(lambda t: t.name, here.iterdir())
-    datasource = (here / "library.tsv").read_text("utf8").splitlines()
-    print(f"using library with {len(datasource)} lines")
-    tracks = [
-        t.split("\t")[0]
-        for t in datasource
-        if t.count("\t") >= 1 and not t.startswith("# vim")
-    ]
-    print(f"from {len(tracks)} tracks")
-    tracks_nested = [a.split(", ") for a in tracks]
-
-    artists = []
-    for t in tracks_nested:
-        artists += t
-
-    counts = {artist: artists.count(artist) for artist in artists}
-
-    total = sum(counts.values())
-
-    (here / "counts.tsv").write_text(
-        f"{total}\t\n" +
-        "\n".join(
-            reversed(sorted((f"{v:2}\t{k}" for k, v in counts.items()), key=natsort))
-        ),
+def count_artists(rows: Iterable[str]) -> Counter:
+    """
+    Counts the artist credits of "artists\ttitle" rows, in one pass
+    """
+    return Counter(
+        artist
+        for row in rows
+        if row.count("\t") >= 1 and not row.startswith("# vim")
+        for artist in row.split("\t")[0].split(", ")
+    )
+
+
+def credits_total(rows: Iterable[str]) -> int:
+    """
+    How many artist credits count_artists would count, without counting them
+    """
+    return sum(
+        row.split("\t")[0].count(", ") + 1
+        for row in rows
+        if row.count("\t") >= 1 and not row.startswith("# vim")
+    )
+
+
+def read_counts(counts_file: Path) -> Counter:
+    counts = Counter()
+    for line in counts_file.read_text("utf8").splitlines()[1:]:
+        count, artist = line.split("\t", 1)
+        counts[artist] = int(count)
+    return counts
+
+
+def write_counts(counts: Counter, counts_file: Path):
+    """
+    Most credited artists first. Artists with the same count are in reverse natural order, like they always were,
+    then in reverse order of their exact name, so that the file only depends on the counts.
+    """
+    ranking = sorted(
+        counts.items(),
+        key=lambda item: (item[1], natsort(item[0]), item[0]),
+        reverse=True,
+    )
+    counts_file.write_text(
+        f"{counts.total()}\t\n" + "\n".join(f"{count:2}\t{artist}" for artist, count in ranking),
         encoding="utf8",
     )
 
+
+def update_artist_counts(silent=True, added_rows: Optional[list[str]] = None):
+    """
+    With added_rows, the rows appended to library.tsv since counts.tsv was last written, only those are counted.
+    If the counts then don't add up to library.tsv's credits (e.g. a backup was interrupted), everything is counted again.
+    """
+    print("counting artists")
+    counts_file = here / "counts.tsv"
+    datasource = (here / "library.tsv").read_text("utf8").splitlines()[1:]  # without the "Artist\tTitle" header
+    counts = None
+    if added_rows is not None and counts_file.exists():
+        print(f"from {len(added_rows)} new tracks")
+        counts = read_counts(counts_file) + count_artists(added_rows)
+        if counts.total() != credits_total(datasource):
+            print("counts.tsv doesn't add up to library.tsv, counting everything again")
+            counts = None
+    if counts is None:
+        print(f"using library with {len(datasource)} lines")
+        counts = count_artists(datasource)
+
+    write_counts(counts, counts_file)
+
     if not silent:
-        print((here / "counts.tsv").read_text("utf8"))
+        print(counts_file.read_text("utf8"))
 
 
 if __name__ == "__main__":
-    update_artist_counts(slient=len(argv) < 2 or argv[1] != "--silent")
+    update_artist_counts(silent="--silent" in argv[1:])